@@ -0,0 +1,85 @@
+"""
+messages / message_reactions への一括取り込み速度(rows/sec)を方式ごとに計測するベンチマーク。
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench DB_SSL=disable \\
+        python -m bench.bulk_ingest --sizes 1000 10000 100000
+
+方式:
+  executemany  旧実装と同じ1行ずつの INSERT
+  values       unnest による複数行 INSERT
+  copy         ステージングテーブルへの COPY + INSERT ... SELECT
+各方式とも空のテーブルへの新規取り込みと、全件が既存(ON CONFLICT で捨てられる)の再取り込みを測る。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from bench.common import bench_dsn, create_bench_pool, discordbot
+
+
+def synthetic_rows(count, thread_id, authors=300, first_message_id=10 ** 15):
+    return [
+        (first_message_id + i, thread_id, 1000 + random.randrange(authors), f"synthetic post {i} " + "x" * random.randint(20, 200))
+        for i in range(count)
+    ]
+
+
+async def executemany_messages(conn, rows):
+    await conn.executemany("""
+        INSERT INTO messages (message_id, thread_id, author_id, content)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (thread_id, message_id) DO NOTHING
+    """, rows, timeout=discordbot.DB_BULK_TIMEOUT)
+
+
+async def timed(pool, func, rows):
+    async with pool.acquire() as conn:
+        started = time.perf_counter()
+        async with conn.transaction():
+            await func(conn, rows)
+        return time.perf_counter() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--methods", nargs="+", default=["executemany", "values", "copy"])
+    args = parser.parse_args()
+
+    pool = await create_bench_pool(bench_dsn(args.dsn))
+    methods = {
+        "executemany": executemany_messages,
+        "values": lambda conn, rows: discordbot.insert_messages(conn, rows, method="values"),
+        "copy": lambda conn, rows: discordbot.insert_messages(conn, rows, method="copy"),
+    }
+    for size in args.sizes:
+        rows = synthetic_rows(size, discordbot.THREAD_ID)
+        reactions = [
+            (row[0], discordbot.READ_LATER_REACTION_ID, user_id)
+            for row in rows
+            for user_id in random.sample(range(1, 51), 2)
+        ]
+        for name in args.methods:
+            await pool.execute("TRUNCATE messages, message_reactions, author_stats, reaction_counts, user_reaction_counts")
+            fresh = await timed(pool, methods[name], rows)
+            duplicate = await timed(pool, methods[name], rows)
+            result = {
+                "table": "messages",
+                "method": name,
+                "rows": size,
+                "fresh_rows_per_s": round(size / fresh),
+                "duplicate_rows_per_s": round(size / duplicate),
+            }
+            if name != "executemany":
+                elapsed = await timed(pool, lambda conn, r: discordbot.insert_reactions(conn, r, method=name), reactions)
+                result["reaction_rows"] = len(reactions)
+                result["reaction_rows_per_s"] = round(len(reactions) / elapsed)
+            print(json.dumps(result), flush=True)
+    await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
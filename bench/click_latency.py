@@ -0,0 +1,106 @@
+"""
+ルーレットのクリック時DBレイテンシを、旧構成(psycopg2 + asyncio.to_thread)と
+現構成(asyncpg プール)で比較するベンチマーク。
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench DB_SSL=disable \\
+        python -m bench.click_latency --messages 20000 --concurrency 1 8 32
+
+BENCH_DATABASE_URL のDBに bench スキーマを作り直して使う。
+旧構成の計測には psycopg2 が必要(requirements.txt には含めていない)。
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+from bench.common import bench_dsn, create_bench_pool, discordbot, seed_thread, summarize, BENCH_SCHEMA
+
+
+def random_spec(users, authors):
+    button_name = random.choice(list(discordbot.BUTTON_FILTERS))
+    user_id = random.randint(1, users)
+    return button_name, discordbot.RouletteFilter.for_button(button_name, user_id, 1000 + random.randrange(authors))
+
+
+async def run_clicks(click, clicks, concurrency, users, authors):
+    samples = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            button_name, spec = random_spec(users, authors)
+            started = time.perf_counter()
+            await click(spec, button_name)
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(clicks)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def make_psycopg2_click(dsn, maxconn):
+    """旧構成: SimpleConnectionPool から接続を取り、to_thread 上で同じクエリを実行する。"""
+    from psycopg2 import pool
+
+    db = pool.SimpleConnectionPool(1, maxconn, dsn=dsn, options=f"-c search_path={BENCH_SCHEMA}")
+    # SimpleConnectionPool は枯渇すると例外になるため、空きを待つ分だけ旧構成に有利に計測する
+    slots = threading.BoundedSemaphore(maxconn)
+
+    def query_sync(spec):
+        query, params = spec.to_sample_query(discordbot.THREAD_ID)
+        query = re.sub(r"\$(\d+)", r"%(p\1)s", query)
+        with slots:
+            conn = db.getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(query, {f"p{i}": v for i, v in enumerate(params, 1)})
+                    return cur.fetchone()
+            finally:
+                conn.rollback()
+                db.putconn(conn)
+
+    async def click(spec, button_name):
+        return await asyncio.to_thread(query_sync, spec)
+
+    return click, db.closeall
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--authors", type=int, default=300)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--clicks", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--skip-psycopg2", action="store_true")
+    args = parser.parse_args()
+
+    dsn = bench_dsn(args.dsn)
+    pool = await create_bench_pool(dsn)
+    await seed_thread(pool, discordbot.THREAD_ID, args.messages, args.authors, args.users)
+
+    async def asyncpg_click(spec, button_name):
+        return await discordbot.get_random_message(discordbot.THREAD_ID, spec, button_name)
+
+    modes = [("asyncpg", asyncpg_click, None)]
+    if not args.skip_psycopg2:
+        modes.insert(0, ("psycopg2_to_thread",) + make_psycopg2_click(dsn, discordbot.DB_POOL_MAX_SIZE))
+
+    results = []
+    for name, click, close in modes:
+        for concurrency in args.concurrency:
+            await run_clicks(click, min(50, args.clicks), concurrency, args.users, args.authors)
+            stats = await run_clicks(click, args.clicks, concurrency, args.users, args.authors)
+            results.append({"mode": name, "concurrency": concurrency, "messages": args.messages, **stats})
+            print(json.dumps(results[-1]), flush=True)
+        if close:
+            close()
+    await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+ベンチマーク共通の補助関数。
+合成スレッドが登録済みのルーレット対象になるよう、THREAD_ID の既定値を与えてから discordbot を読み込む。
+"""
+import logging
+import os
+import statistics
+
+os.environ.setdefault("THREAD_ID", "1")
+
+import asyncpg  # noqa: E402
+
+import discordbot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+BENCH_SCHEMA = "bench"
+
+
+def bench_dsn(dsn=None):
+    dsn = dsn or os.getenv("BENCH_DATABASE_URL") or os.getenv("DATABASE_URL")
+    if not dsn:
+        raise SystemExit("BENCH_DATABASE_URL (または DATABASE_URL) を設定してください。")
+    return dsn
+
+
+async def create_bench_pool(dsn, schema=BENCH_SCHEMA, **kwargs):
+    """
+    専用スキーマを作り直し、search_path をそこに向けたプールを discordbot.db_pool に差し込む。
+    本番テーブルには触れない。
+    """
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {schema}")
+    finally:
+        await conn.close()
+    kwargs.setdefault("min_size", discordbot.DB_POOL_MIN_SIZE)
+    kwargs.setdefault("max_size", discordbot.DB_POOL_MAX_SIZE)
+    pool = await asyncpg.create_pool(
+        dsn=dsn,
+        command_timeout=discordbot.DB_QUERY_TIMEOUT,
+        statement_cache_size=discordbot.DB_STATEMENT_CACHE_SIZE,
+        server_settings={"search_path": schema},
+        **kwargs
+    )
+    discordbot.db_pool = pool
+    await discordbot.initialize_db()
+    return pool
+
+
+async def seed_thread(pool, thread_id, messages, authors, users, read_later=0.05, favorite=0.02, exclude=0.05, first_message_id=10 ** 15):
+    """
+    generate_series で合成スレッドを作る。
+    各ユーザーは投稿の read_later / favorite / exclude の割合にそれぞれのリアクションを付ける。
+    """
+    await pool.execute("""
+        INSERT INTO messages (message_id, thread_id, author_id, content)
+        SELECT $4::BIGINT + g, $1, 1000 + (g % $2), 'synthetic post ' || g
+        FROM generate_series(1, $3::INT) g
+    """, thread_id, authors, messages, first_message_id, timeout=discordbot.DB_BULK_TIMEOUT)
+    for emoji_id, ratio in (
+        (discordbot.READ_LATER_REACTION_ID, read_later),
+        (discordbot.FAVORITE_REACTION_ID, favorite),
+        (discordbot.RANDOM_EXCLUDE_ID, exclude),
+    ):
+        await pool.execute("""
+            INSERT INTO message_reactions (message_id, emoji_id, user_id)
+            SELECT m.message_id, $2, u
+            FROM messages m CROSS JOIN generate_series(1, $3::INT) u
+            WHERE m.thread_id = $1 AND random() < $4
+        """, thread_id, emoji_id, users, ratio, timeout=discordbot.DB_BULK_TIMEOUT)
+    await pool.execute("ANALYZE messages")
+    await pool.execute("ANALYZE message_reactions")
+
+
+def summarize(samples, elapsed):
+    """レイテンシ(秒)の列を p50/p95/p99(ミリ秒) とスループットに要約する。"""
+    ordered = sorted(samples)
+
+    def pct(p):
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3) if ordered else None,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+        "throughput_per_s": round(len(ordered) / elapsed, 1) if elapsed else None,
+    }
@@ -0,0 +1,320 @@
+"""
+Discord に繋がずにボットの処理を動かすための合成データと偽オブジェクト。
+
+SyntheticThread は作者・リアクションの偏り(少数の多作な作者、人気作への集中)を
+Zipf 風の重みで再現し、同じ seed からは常に同じスレッドを生成する。
+Stub* は Discord REST の遅延と 429 を模した偽オブジェクトで、負荷試験(bench.load_test)で使う。
+"""
+import asyncio
+import itertools
+import random
+import time
+from bisect import bisect_left, bisect_right
+
+from bench.common import discordbot
+
+# Discord の snowflake に近い大きさの連番
+FIRST_MESSAGE_ID = 10 ** 18
+
+# ボタン名 -> CombinedView 上の属性名
+BUTTON_ATTRIBUTES = {
+    "blue_random": "blue_random",
+    "blue_read_later": "read_later",
+    "blue_favorite": "favorite",
+    "red_random": "red_random",
+    "red_read_later": "conditional_read_later",
+}
+
+
+def _zipf_cum_weights(count, exponent):
+    total = 0.0
+    cum = []
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        cum.append(total)
+    return cum
+
+
+class SyntheticThread:
+    """
+    messages 件の投稿と、users 人分のリアクションを持つ合成スレッド。
+    各ユーザーのリアクション数は平均 per_user の指数分布、付ける投稿は人気の Zipf 分布から選ぶ。
+    """
+
+    def __init__(self, messages, seed=0, authors=None, users=None, per_user=None, thread_id=None):
+        rng = random.Random(seed)
+        self.thread_id = thread_id or discordbot.THREAD_ID
+        self.author_count = authors or max(10, messages // 40)
+        self.user_count = users or max(20, min(2000, messages // 50))
+        per_user = per_user or {
+            discordbot.READ_LATER_REACTION_ID: 30,
+            discordbot.FAVORITE_REACTION_ID: 10,
+            discordbot.RANDOM_EXCLUDE_ID: 15,
+        }
+
+        author_ids = [10 ** 17 + i for i in range(self.author_count)]
+        author_cum = _zipf_cum_weights(self.author_count, 1.0)
+        authors_by_message = rng.choices(author_ids, cum_weights=author_cum, k=messages)
+        self.messages = [
+            (FIRST_MESSAGE_ID + i, author_id)
+            for i, author_id in enumerate(authors_by_message)
+        ]
+
+        # 人気順はメッセージの新旧と無関係にシャッフルする
+        popularity = [message_id for message_id, _ in self.messages]
+        rng.shuffle(popularity)
+        popularity_cum = _zipf_cum_weights(messages, 0.8)
+        self.user_ids = [2 * 10 ** 17 + i for i in range(self.user_count)]
+        reactions = set()
+        for user_id in self.user_ids:
+            for emoji_id, mean in per_user.items():
+                k = min(messages, int(rng.expovariate(1 / mean)))
+                for message_id in rng.choices(popularity, cum_weights=popularity_cum, k=k):
+                    reactions.add((message_id, emoji_id, user_id))
+        self.reactions = sorted(reactions)
+
+    def message_rows(self):
+        return [(message_id, self.thread_id, author_id, f"synthetic post {message_id}") for message_id, author_id in self.messages]
+
+    def fake_messages(self, channel):
+        return [FakeMessage(message_id, channel, FakeUser(author_id), f"synthetic post {message_id}") for message_id, author_id in self.messages]
+
+
+class FakeUser:
+
+    def __init__(self, user_id, name=None):
+        self.id = user_id
+        self.name = name or f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeMessage:
+
+    def __init__(self, message_id, channel, author, content="", embeds=(), reactions=()):
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embeds = list(embeds)
+        self.reactions = list(reactions)
+
+    async def delete(self):
+        self.channel.remove(self.id)
+
+
+class FakePartialMessage:
+
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def delete(self):
+        self.channel.remove(self.id)
+
+
+class FakeChannel:
+    """
+    channel.history / send / get_partial_message を持つ偽チャンネル。
+    history は discord.py と同じく既定は新しい順、after 指定時は古い順に返す。
+    """
+
+    _ids = itertools.count(FIRST_MESSAGE_ID * 2)
+
+    def __init__(self, channel_id=None, messages=()):
+        self.id = channel_id or discordbot.THREAD_ID
+        self.guild = None
+        self._messages = {m.id: m for m in messages}
+        self._ordered = None
+        self.sent = []
+        self.history_calls = 0
+
+    @property
+    def message_count(self):
+        return len(self._messages)
+
+    def add(self, message):
+        self._messages[message.id] = message
+        self._ordered = None
+
+    def remove(self, message_id):
+        if self._messages.pop(message_id, None) is not None:
+            self._ordered = None
+
+    def _sorted_ids(self):
+        if self._ordered is None:
+            self._ordered = sorted(self._messages)
+        return self._ordered
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        self.history_calls += 1
+        ids = self._sorted_ids()
+        lo = bisect_right(ids, after.id) if after is not None else 0
+        hi = bisect_left(ids, before.id) if before is not None else len(ids)
+        if oldest_first is None:
+            oldest_first = after is not None
+        if limit is None:
+            limit = hi - lo
+        if oldest_first:
+            window = ids[lo:min(hi, lo + limit)]
+        else:
+            window = ids[max(lo, hi - limit):hi][::-1]
+        for message_id in window:
+            yield self._messages[message_id]
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        message = FakeMessage(next(self._ids), self, discordbot.bot.user, content or "", [embed] if embed else [])
+        self.add(message)
+        self.sent.append(message)
+        return message
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self, message_id)
+
+    async def fetch_message(self, message_id):
+        message = self._messages.get(message_id)
+        if message is None:
+            raise LookupError(message_id)
+        return message
+
+
+class FakeResponse:
+
+    def __init__(self):
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, *args, **kwargs):
+        self._done = True
+
+
+class FakeFollowup:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class FakeInteraction:
+
+    def __init__(self, user_id, channel, guild_id=1):
+        self.user = FakeUser(user_id)
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild_id = guild_id
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+def install_fake_channel(channel):
+    """discordbot.bot.get_channel が偽チャンネルを返すようにする。"""
+    discordbot.bot.get_channel = lambda channel_id: channel if channel_id == channel.id else None
+
+
+class StubDiscordHTTP:
+    """
+    Discord REST の代わりに、呼び出しごとに latency を足し、rate_limit の確率で 429 を返す。
+    429 は discord.py と同じく Retry-After だけ待って再試行し、応答は rest_scheduler にも伝える。
+    """
+
+    def __init__(self, latency=0.05, jitter=0.3, rate_limit=0.0, retry_after=1.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def request(self, route):
+        while True:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.latency * self.jitter)))
+            self.requests += 1
+            if self.rng.random() >= self.rate_limit:
+                discordbot.rest_scheduler.observe(route, 200, {})
+                return
+            self.rate_limited += 1
+            discordbot.rest_scheduler.observe(route, 429, {
+                "Retry-After": str(self.retry_after),
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset-After": str(self.retry_after),
+            })
+            await asyncio.sleep(self.retry_after)
+
+
+class StubChannel(FakeChannel):
+    """送信・削除のたびに StubDiscordHTTP を通る FakeChannel。"""
+
+    def __init__(self, http, channel_id=None, messages=()):
+        super().__init__(channel_id, messages)
+        self.http = http
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        await self.http.request("POST /channels/:id/messages")
+        return await super().send(content, embed=embed, view=view, **kwargs)
+
+    def get_partial_message(self, message_id):
+        return StubPartialMessage(self, message_id)
+
+
+class StubPartialMessage(FakePartialMessage):
+
+    async def delete(self):
+        await self.channel.http.request("DELETE /channels/:id/messages/:id")
+        await super().delete()
+
+
+class StubResponse(FakeResponse):
+
+    def __init__(self, http):
+        super().__init__()
+        self.http = http
+
+    async def defer(self, **kwargs):
+        await self.http.request("POST /interactions/:id/:token/callback")
+        await super().defer(**kwargs)
+
+    async def send_message(self, *args, **kwargs):
+        await self.http.request("POST /interactions/:id/:token/callback")
+        await super().send_message(*args, **kwargs)
+
+
+class ClickChannel:
+    """
+    1回のクリック用にチャンネルを包み、最初の send (おすすめの投稿) が終わった時刻を記録する。
+    それ以外の属性は包んだチャンネルに委ねる。
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.responded_at = None
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    async def send(self, *args, **kwargs):
+        message = await self._channel.send(*args, **kwargs)
+        if self.responded_at is None:
+            self.responded_at = time.perf_counter()
+        return message
+
+
+class StubInteraction(FakeInteraction):
+
+    def __init__(self, user_id, channel, http, guild_id=1):
+        super().__init__(user_id, ClickChannel(channel), guild_id)
+        self.response = StubResponse(http)
@@ -0,0 +1,197 @@
+"""
+パネルのボタンを多数のメンバーが同時に押したときの負荷試験。
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench DB_SSL=disable \\
+        python -m bench.load_test --users 1 10 50 200 --duration 20 --latency-ms 80 --rate-limit 0.02
+
+--users の人数ぶんの仮想ユーザーが、think time を挟みながら CombinedView のボタンを押し続ける。
+Discord の REST は bench.fakes.StubDiscordHTTP で置き換え、呼び出しごとに遅延を足し、
+--rate-limit の確率で 429 を返す。DB を使う経路(パネルIDの保存、--sql での抽出、--reaction-rate の書き込み)は
+BENCH_DATABASE_URL (または --dsn) があるときだけ bench スキーマ上で動かす。
+
+人数ごとに、押下からおすすめ投稿の送信までと、コールバック全体の p50/p95/p99、スループット、
+DBプールの使用数、REST スケジューラの待ち行列、リアクション書き込みキュー、
+to_thread の待ち行列とイベントループの遅れを1行のJSONで出力する。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+from bench.common import bench_dsn, create_bench_pool, discordbot, summarize
+from bench.fakes import BUTTON_ATTRIBUTES, StubChannel, StubDiscordHTTP, StubInteraction, SyntheticThread
+
+
+class Sampler:
+    """interval 秒ごとに待ち行列・プール・イベントループの遅れを記録する。"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+        self._task = None
+
+    def _record(self, name, value):
+        self.samples.setdefault(name, []).append(value)
+
+    def _sample(self, lag):
+        pool = discordbot.db_pool
+        if pool is not None:
+            self._record("db_pool_in_use", pool.get_size() - pool.get_idle_size())
+            self._record("db_pool_utilization", (pool.get_size() - pool.get_idle_size()) / pool.get_max_size())
+        for (lane,), depth in discordbot.rest_scheduler.queue_depths().items():
+            self._record(f"rest_queue_{lane}", depth)
+        self._record("reaction_queue", len(discordbot.reaction_queue))
+        executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+        self._record("to_thread_queue", executor._work_queue.qsize() if executor is not None else 0)
+        self._record("loop_lag_ms", lag * 1000)
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self._sample(time.perf_counter() - started - self.interval)
+
+    def start(self):
+        self.samples = {}
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self):
+        return {
+            name: {"mean": round(sum(values) / len(values), 3), "max": round(max(values), 3)}
+            for name, values in sorted(self.samples.items())
+        }
+
+
+async def run_level(users, duration, think, thread, channel, http, rng):
+    """users 人が duration 秒ボタンを押し続け、1回ごとの応答時間とコールバック全体の時間を集める。"""
+    view = discordbot.CombinedView()
+    buttons = [getattr(view, attribute) for attribute in BUTTON_ATTRIBUTES.values()]
+    response_samples = []
+    callback_samples = []
+    # 例外の型名 -> 件数。失敗しても think time は挟み、失敗が空回りでリクエストを水増ししないようにする
+    errors = {}
+    deadline = time.perf_counter() + duration
+
+    async def member(user_id):
+        while time.perf_counter() < deadline:
+            interaction = StubInteraction(user_id, channel, http)
+            started = time.perf_counter()
+            try:
+                await rng.choice(buttons).callback(interaction)
+            except Exception as e:
+                name = type(e).__name__
+                if name not in errors:
+                    logging.getLogger(__name__).warning(f"Click failed: {e!r}")
+                errors[name] = errors.get(name, 0) + 1
+            else:
+                callback_samples.append(time.perf_counter() - started)
+                if interaction.channel.responded_at is not None:
+                    response_samples.append(interaction.channel.responded_at - started)
+            # think time 0 でも、同期的に失敗し続けるクリックがイベントループを占有しないよう一度は譲る
+            await asyncio.sleep(rng.expovariate(1 / think) if think else 0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(member(rng.choice(thread.user_ids)) for _ in range(users)))
+    elapsed = time.perf_counter() - started
+    for task in list(discordbot._panel_pending.values()):
+        task.cancel()
+    discordbot._panel_pending.clear()
+    return summarize(response_samples, elapsed), summarize(callback_samples, elapsed), errors
+
+
+async def reaction_load(rate, thread, rng):
+    """rate 件/秒のリアクション追加・削除を書き込みキューに積み続ける。"""
+    while True:
+        await asyncio.sleep(rng.expovariate(rate))
+        message_id, _ = rng.choice(thread.messages)
+        add = rng.random() < 0.7
+        user_id = rng.choice(thread.user_ids)
+        discordbot.reaction_queue.put(message_id, discordbot.READ_LATER_REACTION_ID, user_id, add=add)
+        discordbot.message_catalogs[thread.thread_id].apply_reaction(message_id, discordbot.READ_LATER_REACTION_ID, user_id, add)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--duration", type=float, default=20, help="1段階あたりの秒数")
+    parser.add_argument("--think-ms", type=float, default=500, help="クリック間隔の平均(0で間隔なし)")
+    parser.add_argument("--latency-ms", type=float, default=80, help="Discord REST 1回あたりの平均遅延")
+    parser.add_argument("--jitter", type=float, default=0.3, help="遅延の標準偏差(平均に対する割合)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="429 を返す確率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 の Retry-After(秒)")
+    parser.add_argument("--reaction-rate", type=float, default=0, help="並行して流すリアクション操作(件/秒)")
+    parser.add_argument("--pool-size", type=int, help="DBプールの最大接続数(省略時は DB_POOL_MAX_SIZE)")
+    parser.add_argument("--sql", action="store_true", help="カタログを使わず毎回SQLで抽出する")
+    parser.add_argument("--sample-ms", type=float, default=10, help="待ち行列などを記録する間隔")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        dsn = bench_dsn(args.dsn)
+    except SystemExit:
+        if args.sql or args.reaction_rate:
+            raise
+        dsn = None
+    pool_options = {"max_size": args.pool_size} if args.pool_size else {}
+    pool = await create_bench_pool(dsn, **pool_options) if dsn else None
+
+    rng = random.Random(args.seed)
+    thread = SyntheticThread(args.messages, seed=args.seed)
+    if pool:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await discordbot.insert_messages(conn, thread.message_rows())
+                await discordbot.insert_reactions(conn, thread.reactions)
+        await pool.execute("ANALYZE messages")
+        await pool.execute("ANALYZE message_reactions")
+    catalog = discordbot.MessageCatalog()
+    if not args.sql:
+        catalog.load(thread.messages, thread.reactions)
+    discordbot.message_catalogs[thread.thread_id] = catalog
+
+    http = StubDiscordHTTP(args.latency_ms / 1000, args.jitter, args.rate_limit, args.retry_after, seed=args.seed)
+    channel = StubChannel(http, thread.thread_id)
+    sampler = Sampler(args.sample_ms / 1000)
+    reactions = None
+    if args.reaction_rate:
+        discordbot.reaction_queue.start()
+        reactions = asyncio.create_task(reaction_load(args.reaction_rate, thread, rng))
+
+    for users in args.users:
+        requests, rate_limited = http.requests, http.rate_limited
+        sampler.start()
+        response, callback, errors = await run_level(users, args.duration, args.think_ms / 1000, thread, channel, http, rng)
+        await sampler.stop()
+        result = {
+            "users": users,
+            "messages": args.messages,
+            "mode": "sql" if args.sql else "catalog",
+            "response": response,
+            "callback": callback,
+            "errors": errors,
+            "rest_requests": http.requests - requests,
+            "rest_429": http.rate_limited - rate_limited,
+            **sampler.summary(),
+        }
+        print(json.dumps(result), flush=True)
+
+    if reactions is not None:
+        reactions.cancel()
+        await discordbot.reaction_queue.stop()
+    if pool:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+"""
+Discord ギルドなしでボットの主要経路を計測するオフラインベンチマーク。
+
+    python -m bench.suite --sizes 1000 10000 100000 --output before.json
+    python -m bench.suite --sizes 1000 10000 100000 --compare before.json
+
+合成スレッド(bench.fakes.SyntheticThread)と偽の Interaction / channel.history を使う。
+カタログ経路は常に計測し、DBを使う経路は BENCH_DATABASE_URL (または --dsn) があるときだけ
+bench スキーマ上で計測する。結果はキーを整列した JSON で出力するので、コミット間で比較できる。
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from bench.common import bench_dsn, create_bench_pool, discordbot, summarize
+from bench.fakes import BUTTON_ATTRIBUTES, FakeChannel, FakeInteraction, SyntheticThread, install_fake_channel
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def time_ops(func, ops):
+    """func(i) を ops 回呼び、1回ごとの所要時間を要約する。"""
+    samples = []
+    started = time.perf_counter()
+    for i in range(ops):
+        t = time.perf_counter()
+        await func(i)
+        samples.append(time.perf_counter() - t)
+    return summarize(samples, time.perf_counter() - started)
+
+
+async def time_once(func, repeats):
+    samples = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - t)
+    return summarize(samples, sum(samples))
+
+
+def fresh_catalog(thread):
+    catalog = discordbot.MessageCatalog()
+    catalog.load(thread.messages, thread.reactions)
+    discordbot.message_catalogs[thread.thread_id] = catalog
+    return catalog
+
+
+async def catalog_scenarios(thread, size, ops, rng):
+    results = []
+
+    async def load():
+        fresh_catalog(thread)
+    results.append({"scenario": "catalog_load", "size": size, **await time_once(load, 3)})
+
+    catalog = fresh_catalog(thread)
+    for button_name in discordbot.BUTTON_FILTERS:
+        users = [rng.choice(thread.user_ids) for _ in range(ops)]
+
+        async def pick(i):
+            catalog.pick(discordbot.RouletteFilter.for_button(button_name, users[i]))
+        results.append({"scenario": "catalog_pick", "button": button_name, "size": size, **await time_ops(pick, ops)})
+
+    for strategy in discordbot.SAMPLING_STRATEGIES:
+        users = [rng.choice(thread.user_ids) for _ in range(ops)]
+
+        async def pick_with(i):
+            spec = discordbot.RouletteFilter.for_button("blue_random", users[i])
+            spec.strategy = strategy
+            catalog.pick(spec)
+        results.append({"scenario": "catalog_pick_strategy", "strategy": strategy, "size": size, **await time_ops(pick_with, ops)})
+
+    # ボタン押下からパネル再投稿までを偽の Interaction で通しで動かす
+    channel = FakeChannel(thread.thread_id)
+    view = discordbot.CombinedView()
+    for button_name, attribute in BUTTON_ATTRIBUTES.items():
+        button = getattr(view, attribute)
+        users = [rng.choice(thread.user_ids) for _ in range(ops)]
+
+        async def click(i):
+            await button.callback(FakeInteraction(users[i], channel))
+        results.append({"scenario": "click", "button": button_name, "size": size, **await time_ops(click, ops)})
+    for task in list(discordbot._panel_pending.values()):
+        task.cancel()
+    discordbot._panel_pending.clear()
+    return results
+
+
+async def db_scenarios(pool, thread, size, ops, rng):
+    results = []
+    await pool.execute("TRUNCATE messages, message_reactions, sync_state, author_stats, reaction_counts, user_reaction_counts")
+    rows = thread.message_rows()
+
+    channel = FakeChannel(thread.thread_id)
+    messages = thread.fake_messages(channel)
+
+    async def bulk_save():
+        await pool.execute("TRUNCATE messages, author_stats")
+        await discordbot.bulk_save_messages_to_db(messages)
+    results.append({"scenario": "bulk_save_messages", "size": size, **await time_once(bulk_save, 3)})
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await discordbot.insert_reactions(conn, thread.reactions)
+    await pool.execute("ANALYZE messages")
+    await pool.execute("ANALYZE message_reactions")
+
+    for button_name in discordbot.BUTTON_FILTERS:
+        users = [rng.choice(thread.user_ids) for _ in range(ops)]
+
+        async def sql_pick(i):
+            spec = discordbot.RouletteFilter.for_button(button_name, users[i])
+            await discordbot.get_random_message(thread.thread_id, spec, button_name)
+        results.append({"scenario": "sql_pick", "button": button_name, "size": size, **await time_ops(sql_pick, ops)})
+
+    # /search: 投稿IDの末尾6桁(数件に絞られる語)で1ページ目と検索結果からのルーレットを引く
+    queries = [str(rng.choice(rows)[0])[-6:] for _ in range(ops)]
+
+    async def search(i):
+        await discordbot.search_messages(thread.thread_id, queries[i], discordbot.SEARCH_PAGE_SIZE + 1)
+    results.append({"scenario": "search", "size": size, **await time_ops(search, ops)})
+
+    async def search_pick(i):
+        await discordbot.pick_search_match(thread.thread_id, queries[i])
+    results.append({"scenario": "search_roulette", "size": size, **await time_ops(search_pick, ops)})
+
+    # リアクションイベントの書き込み(旧 _update_reactions_in_db_sync 相当)を、キューのフラッシュ単位で測る
+    for batch in (1, discordbot.REACTION_FLUSH_MAX_PENDING):
+        def random_op():
+            message_id = rng.choice(rows)[0]
+            return message_id, discordbot.READ_LATER_REACTION_ID, rng.choice(thread.user_ids)
+
+        async def flush(i):
+            queue = discordbot.ReactionWriteQueue(60, batch + 1)
+            for _ in range(batch):
+                queue.put(*random_op(), add=rng.random() < 0.7)
+            await queue.flush()
+        results.append({"scenario": "reaction_flush", "batch": batch, "size": size, **await time_ops(flush, max(10, ops // 10))})
+
+    # 同期: 既存分を保存済みにして、末尾1%(最低100件)だけが新着の状態から取り込む
+    for message in messages:
+        channel.add(message)
+    install_fake_channel(channel)
+    new_count = max(100, size // 100)
+    high_water_mark = rows[-new_count - 1][0] if size > new_count else None
+
+    async def sync_incremental():
+        await pool.execute("DELETE FROM messages WHERE message_id > $1", high_water_mark or 0)
+        await pool.execute("TRUNCATE sync_state")
+        await pool.execute("INSERT INTO sync_state (thread_id, last_message_id, last_full_sync_at) VALUES ($1, $2, now())",
+                           thread.thread_id, high_water_mark)
+        await discordbot.save_all_messages_to_db()
+    results.append({"scenario": "sync_incremental", "new_messages": new_count, "size": size, **await time_once(sync_incremental, 3)})
+
+    async def sync_full():
+        await discordbot.save_all_messages_to_db(full=True)
+    results.append({"scenario": "sync_full", "size": size, "history_pages": -(-size // 100), **await time_once(sync_full, 1)})
+    return results
+
+
+def result_key(result):
+    return tuple(str(result.get(k, "")) for k in ("scenario", "button", "strategy", "batch", "size"))
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+    regressions = 0
+    for result in results:
+        old = baseline.get(result_key(result))
+        if not old or not old.get("p50_ms") or not result.get("p50_ms"):
+            continue
+        ratio = result["p50_ms"] / old["p50_ms"]
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        regressions += bool(flag)
+        print(f"{' '.join(k for k in result_key(result) if k):55s} {old['p50_ms']:>10.3f} -> {result['p50_ms']:>10.3f} ms  x{ratio:.2f} {flag}", file=sys.stderr)
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ops", type=int, default=500, help="1シナリオあたりの操作回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果JSONの出力先(省略時は標準出力)")
+    parser.add_argument("--compare", help="比較対象の結果JSON。p50 が threshold を超えて悪化したら終了コード1")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    try:
+        dsn = bench_dsn(args.dsn)
+    except SystemExit:
+        dsn = None
+    pool = await create_bench_pool(dsn) if dsn else None
+
+    results = []
+    for size in args.sizes:
+        rng = random.Random(args.seed)
+        thread = SyntheticThread(size, seed=args.seed)
+        results.extend(await catalog_scenarios(thread, size, args.ops, rng))
+        if pool:
+            results.extend(await db_scenarios(pool, thread, size, args.ops, rng))
+    if pool:
+        await pool.close()
+
+    report = {
+        "meta": {
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "seed": args.seed,
+            "sizes": args.sizes,
+            "ops": args.ops,
+            "database": bool(pool),
+        },
+        "results": sorted(results, key=result_key),
+    }
+    text = json.dumps(report, sort_keys=True, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare and compare(report["results"], args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
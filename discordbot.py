@@ -1,14 +1,30 @@
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 from datetime import datetime, timedelta
 import os
+import signal
+import socket
 import random
 import logging
 import asyncio
-from psycopg2 import pool, Error
-from psycopg2.extras import DictCursor
-from dotenv import load_dotenv
+import time
+import functools
+import re
+import hashlib
+import mmap
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import chain
+from contextlib import asynccontextmanager
+import atexit
 import json
+import queue
+import logging.handlers
+import aiohttp
+import asyncpg
+from dotenv import load_dotenv
 
 
 ########################
@@ -23,33 +39,189 @@ load_dotenv()
 DEBUG_MODE = os.getenv("DEBUG_MODE", "False").lower() in ("true", "1", "t")
 log_level = logging.DEBUG if DEBUG_MODE else logging.INFO
 
-logging.basicConfig(
-    level=log_level,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+# "json" で1行1オブジェクトの構造化ログ
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# LOG_ROTATE_WHEN (例: "midnight") を指定すると時間で、未指定ならサイズでローテーションする
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# 高頻度イベントのログを同じキーにつき何秒に1回に間引くか
+LOG_SAMPLE_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", "10"))
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする。extra で渡した項目もそのまま出力する。"""
+
+    _STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self._STANDARD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """
+    イベントループ上ではキューに積むだけにし、ファイル・標準出力への書き込みは
+    QueueListener のバックグラウンドスレッドで行う。
+    """
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 
+class SampledLog:
+    """
+    リアクションイベントのような高頻度ログを、キーごとに interval 秒に1回だけ出す。
+    間引いた件数は次に出力するレコードの suppressed に載せる。
+    """
+
+    def __init__(self, logger, interval):
+        self.logger = logger
+        self.interval = interval
+        self._last = {}
+        self._suppressed = {}
+
+    def log(self, level, key, msg, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        if now - self._last.get(key, -self.interval) < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return
+        self._last[key] = now
+        suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            msg = f"{msg} (+{suppressed} similar suppressed)"
+        self.logger.log(level, msg, extra={"event": key, "suppressed": suppressed, **fields})
+
+    def info(self, key, msg, **fields):
+        self.log(logging.INFO, key, msg, **fields)
+
+
+hot_log = SampledLog(logger, LOG_SAMPLE_INTERVAL)
+
+
 ########################
 # 環境変数・定数
 ########################
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# ルーレット対象のスレッドは roulette_threads テーブルで管理する。
+# THREAD_ID を設定した場合は、そのスレッドを起動時に登録する(単一スレッド運用からの移行用)
 THREAD_ID = os.getenv("THREAD_ID")
-if THREAD_ID is None:
-    logger.error("THREAD_IDが設定されていません。環境変数を確認してください。")
-    exit(1)
-
-try:
-    THREAD_ID = int(THREAD_ID)
-except ValueError:
-    logger.error("THREAD_IDが無効な値です。正しいチャンネルID(数値)を設定してください。")
+if THREAD_ID is not None:
+    try:
+        THREAD_ID = int(THREAD_ID)
+    except ValueError:
+        logger.error("THREAD_IDが無効な値です。正しいチャンネルID(数値)を設定してください。")
+        exit(1)
+
+# 取りこぼし補完のための履歴同期の間隔(分)。新着・編集・削除は Gateway イベントで即時に反映する
+SYNC_RECONCILE_INTERVAL_MINUTES = float(os.getenv("SYNC_RECONCILE_INTERVAL_MINUTES", "60"))
+# 全履歴を走査し直す整合性チェックの間隔(時間)。0 で無効。
+FULL_SYNC_INTERVAL_HOURS = float(os.getenv("FULL_SYNC_INTERVAL_HOURS", "24"))
+# 整合性チェックで件数・ハッシュを比べるID範囲の幅(時間)
+RECONCILE_RANGE_HOURS = float(os.getenv("RECONCILE_RANGE_HOURS", "24"))
+RECONCILE_RANGE_MS = max(1, int(RECONCILE_RANGE_HOURS * 3600 * 1000))
+
+# リアクション書き込みキューのフラッシュ間隔(秒)と、即時フラッシュする溜まり件数
+REACTION_FLUSH_INTERVAL = float(os.getenv("REACTION_FLUSH_INTERVAL", "1.0"))
+REACTION_FLUSH_MAX_PENDING = int(os.getenv("REACTION_FLUSH_MAX_PENDING", "200"))
+
+# /save の進捗を報告する間隔(秒)
+BACKFILL_PROGRESS_INTERVAL = float(os.getenv("BACKFILL_PROGRESS_INTERVAL", "30"))
+
+# この件数以上の一括取り込みはステージングテーブルへの COPY、未満は unnest による複数行 INSERT を使う
+BULK_COPY_THRESHOLD = int(os.getenv("BULK_COPY_THRESHOLD", "500"))
+
+# 作者の表示名キャッシュの最大件数と有効期限(時間)
+AUTHOR_NAME_CACHE_SIZE = int(os.getenv("AUTHOR_NAME_CACHE_SIZE", "10000"))
+AUTHOR_NAME_TTL_HOURS = float(os.getenv("AUTHOR_NAME_TTL_HOURS", "24"))
+
+# この秒数以内に続いたパネルの再投稿は1回にまとめる
+PANEL_DEBOUNCE_SECONDS = float(os.getenv("PANEL_DEBOUNCE_SECONDS", "3"))
+
+# /search の1ページの件数と、結果のボタンを受け付ける時間(秒)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+SEARCH_VIEW_TIMEOUT = float(os.getenv("SEARCH_VIEW_TIMEOUT", "600"))
+
+# ユーザーごとに再度おすすめしない直近件数(0 で無効)・有効期限(時間)・DBへの書き戻し間隔(秒)
+RECOMMEND_HISTORY_SIZE = int(os.getenv("RECOMMEND_HISTORY_SIZE", "20"))
+if RECOMMEND_HISTORY_SIZE < 0:
+    logger.error("RECOMMEND_HISTORY_SIZEが無効な値です。0以上の整数を設定してください。")
     exit(1)
+RECOMMEND_HISTORY_TTL_HOURS = float(os.getenv("RECOMMEND_HISTORY_TTL_HOURS", "24"))
+RECOMMEND_HISTORY_FLUSH_INTERVAL = float(os.getenv("RECOMMEND_HISTORY_FLUSH_INTERVAL", "60"))
+
+# バルスで削除対象にする遡り時間(時間)と、削除の進捗を更新する間隔(秒)
+BALUS_WINDOW_HOURS = float(os.getenv("BALUS_WINDOW_HOURS", "1"))
+BALUS_PROGRESS_INTERVAL = float(os.getenv("BALUS_PROGRESS_INTERVAL", "5"))
+
+# Discord REST 呼び出しのレーンごとの同時実行数(クリック応答 > リアクション取り込み > 同期・バックフィル)
+REST_INTERACTIVE_CONCURRENCY = int(os.getenv("REST_INTERACTIVE_CONCURRENCY", "8"))
+REST_REACTION_CONCURRENCY = int(os.getenv("REST_REACTION_CONCURRENCY", "4"))
+REST_BACKGROUND_CONCURRENCY = int(os.getenv("REST_BACKGROUND_CONCURRENCY", "4"))
+# バックグラウンドレーンは、ルートの残りリクエスト数がこの値以下ならリセットまで待つ
+REST_BACKGROUND_RESERVE = int(os.getenv("REST_BACKGROUND_RESERVE", "2"))
+
+# ルーレットの抽出方法: uniform(一様) / favorites(お気に入り数で重み付け) / authors(作者を一様に選んでから投稿を選ぶ)
+ROULETTE_STRATEGY = os.getenv("ROULETTE_STRATEGY", "uniform")
+# ボタンごとの上書き。例: "blue_random=favorites,red_random=authors"
+ROULETTE_BUTTON_STRATEGIES = os.getenv("ROULETTE_BUTTON_STRATEGIES", "")
+
+# 複数プロセスで動かすときに有効にする。LISTEN/NOTIFY でキャッシュを揃え、同期ループはリーダーだけが回す
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "False").lower() in ("true", "1", "t")
+# このプロセスが受け持つシャード。SHARD_IDS は "0,1" や "0-3" の形式で、SHARD_COUNT と併せて指定する
+SHARD_COUNT = os.getenv("SHARD_COUNT")
+SHARD_IDS = os.getenv("SHARD_IDS")
+
+# ルーレット候補とリアクション状態のスナップショット。起動時にDBより先に読み込み、DBが落ちている間はこれで応答する。
+# 空にすると作らない。Heroku の dyno の再作成を跨ぎたい場合は永続ボリューム上のパスを指定する
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "catalog_snapshot.bin")
+SNAPSHOT_INTERVAL_MINUTES = float(os.getenv("SNAPSHOT_INTERVAL_MINUTES", "10"))
+# 起動時にDBへ繋がらない場合の再試行間隔の上限(秒)
+DB_RECONNECT_MAX_DELAY = float(os.getenv("DB_RECONNECT_MAX_DELAY", "60"))
+
+# Prometheus 形式の /metrics を公開するポート。未設定なら公開しない
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 
 
 ########################
@@ -68,66 +240,824 @@ SPECIFIC_EXCLUDE_USER = 695096014482440244
 
 
 ########################
-# DB接続プール
+# メトリクス
 ########################
-try:
-    db_pool = pool.SimpleConnectionPool(
-        minconn=1,
-        maxconn=10,
-        dsn=DATABASE_URL,
-        sslmode="require"
-    )
-    logger.info("Database connection pool initialized.")
-except Error as e:
-    logger.error(f"Database connection pool initialization error: {e}")
-    db_pool = None
+# 記録はメモリ上のカウンタを増やすだけで、文字列化は /metrics が読まれたときにだけ行う
+METRICS = []
 
 
-def get_db_connection():
-    if db_pool:
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    """読み出し時に callback を呼んで値を得るゲージ。callback は {ラベル値のタプル: 値} を返す。"""
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+        METRICS.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.callback().items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # [各バケットの件数(非累積)..., +Inf の件数, 合計]
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class _Timer:
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CLICK_SECONDS = Histogram("roulette_click_seconds", "Time from button press to recommendation sent.", ("button",))
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Duration of DB access functions.", ("function",))
+DISCORD_REST_SECONDS = Histogram("discord_rest_seconds", "Duration of Discord REST calls.", ("method", "route"))
+DISCORD_REST_REQUESTS = Counter("discord_rest_requests_total", "Discord REST calls by response status.", ("method", "route", "status"))
+DISCORD_REST_RATE_LIMITED = Counter("discord_rest_rate_limited_total", "Discord REST calls answered with 429.", ("method", "route"))
+SYNC_SECONDS = Histogram("sync_seconds", "Duration of history sync runs.", ("mode",), buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800))
+SYNC_ROWS = Counter("sync_rows_ingested_total", "Messages fetched and stored by history sync.", ("mode",))
+RECONCILE_RANGES = Counter("reconcile_ranges_total", "ID ranges compared by reconciliation, by result.", ("result",))
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "asyncpg pool connections by state.",
+    lambda: {} if db_pool is None else {
+        ("in_use",): db_pool.get_size() - db_pool.get_idle_size(),
+        ("idle",): db_pool.get_idle_size(),
+        ("max",): db_pool.get_max_size(),
+    },
+    ("state",)
+)
+CACHE_ENTRIES = Gauge(
+    "cache_entries", "Entries held by in-process caches and queues.",
+    lambda: {
+        ("message_catalog",): sum(len(catalog) for catalog in message_catalogs.values()),
+        ("author_names",): len(author_names),
+        ("recommendation_history",): len(recommendation_history),
+        ("reaction_write_queue",): len(reaction_queue),
+    },
+    ("cache",)
+)
+EVENT_LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "How late a periodic event-loop tick fired.", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+
+def db_timed(func):
+    """DBアクセス関数の所要時間を db_query_seconds{function=...} に記録するデコレータ。"""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
         try:
-            return db_pool.getconn()
-        except Error as e:
-            logger.error(f"Error getting database connection: {e}")
-            return None
-    else:
-        logger.error("Database connection pool is not initialized.")
+            return await func(*args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+_ID_IN_PATH = re.compile(r"/\d{5,}")
+_API_PREFIX = re.compile(r"^/api/v\d+")
+_EMOJI_IN_PATH = re.compile(r"/reactions/[^/]+")
+# インタラクションの応答・フォローアップの URL にはトークンが入るので、ラベルに残さない
+_TOKEN_IN_PATH = re.compile(r"^/(interactions|webhooks)/(\d+)/[^/]+")
+# ルート名に残してよい固定のパス要素。これ以外を含むパスは "other" にまとめる
+_KNOWN_PATH_SEGMENTS = {
+    ":id", ":emoji", ":token", "@me", "@original",
+    "applications", "bulk-delete", "callback", "channels", "commands", "gateway", "bot", "guilds",
+    "interactions", "members", "messages", "reactions", "threads", "users", "webhooks",
+}
+
+
+def rest_path(path):
+    """'/channels/:id/messages' のような、ID・絵文字・トークンを伏せたパスにする。未知のパスは "other"。"""
+    path = _TOKEN_IN_PATH.sub(r"/\1/\2/:token", _API_PREFIX.sub("", path))
+    path = _ID_IN_PATH.sub("/:id", _EMOJI_IN_PATH.sub("/reactions/:emoji", path))
+    if not all(segment in _KNOWN_PATH_SEGMENTS for segment in path.strip("/").split("/")):
+        return "other"
+    return path
+
+
+def rest_route(method, path):
+    """'GET /channels/:id/messages' のようなルート名にする。"""
+    return f"{method} {rest_path(path)}"
+
+
+def make_http_trace():
+    """
+    discord.py の HTTP セッションに差し込む aiohttp.TraceConfig。
+    URL中のIDやトークンを伏せたルートごとに、呼び出し数・429・所要時間を記録し、
+    レート制限ヘッダを rest_scheduler に渡す。
+    """
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def on_request_end(session, ctx, params):
+        route = rest_path(params.url.path)
+        status = params.response.status
+        DISCORD_REST_SECONDS.observe(time.perf_counter() - ctx.started, params.method, route)
+        DISCORD_REST_REQUESTS.inc(params.method, route, status)
+        if status == 429:
+            DISCORD_REST_RATE_LIMITED.inc(params.method, route)
+        rest_scheduler.observe(rest_route(params.method, params.url.path), status, params.response.headers)
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+async def monitor_event_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - expected))
+
+
+async def _handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    if not METRICS_PORT:
         return None
+    server = await asyncio.start_server(_handle_metrics_request, METRICS_HOST, int(METRICS_PORT))
+    asyncio.create_task(monitor_event_loop_lag())
+    logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
 
 
-def release_db_connection(conn):
-    if db_pool and conn:
+########################
+# REST スケジューラ
+########################
+class RestScheduler:
+    """
+    Discord REST 呼び出しを優先度つきのレーンに振り分ける。
+    上位レーンに待ちがある間は下位レーンを開始させず、レーンごとに同時実行数を制限する。
+    応答ヘッダからルートごとの残りリクエスト数を覚えておき、下位レーンは予備分を残してリセットを待つ。
+    429 自体の再試行は discord.py に任せる。
+    """
+
+    LANES = ("interactive", "reaction", "background")
+
+    def __init__(self, concurrency, reserve):
+        self.concurrency = concurrency
+        self.reserve = reserve
+        self._queues = {lane: deque() for lane in self.LANES}
+        self._active = dict.fromkeys(self.LANES, 0)
+        # route -> (残りリクエスト数, リセット時刻(monotonic))
+        self._buckets = {}
+        self._global_reset_at = 0.0
+
+    def observe(self, route, status, headers):
+        now = time.monotonic()
+        if route not in self._buckets:
+            self._prune(now)
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None:
+            self._buckets[route] = (int(remaining), now + float(reset_after))
+        if status == 429:
+            retry_after = float(headers.get("Retry-After") or reset_after or 1)
+            if headers.get("X-RateLimit-Global"):
+                self._global_reset_at = now + retry_after
+            else:
+                self._buckets[route] = (0, now + retry_after)
+
+    def _prune(self, now):
+        # リセット時刻を過ぎたバケットは待ちに影響しないので捨てる
+        for route in [r for r, (_, reset_at) in self._buckets.items() if reset_at <= now]:
+            del self._buckets[route]
+
+    def queue_depths(self):
+        return {(lane,): len(self._queues[lane]) for lane in self.LANES}
+
+    def active_counts(self):
+        return {(lane,): self._active[lane] for lane in self.LANES}
+
+    @asynccontextmanager
+    async def slot(self, lane, route=None):
+        """
+        lane の枠を1つ確保してから抜ける。route を渡すと、その残り枠が予備分以下の間はリセットまで待つ。
+        ページングする iterator など、複数回の呼び出しをまとめて1枠で囲んでもよい。
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[lane].append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(lane)
+            elif waiter in self._queues[lane]:
+                self._queues[lane].remove(waiter)
+                self._dispatch()
+            raise
         try:
-            db_pool.putconn(conn)
-        except Error as e:
-            logger.error(f"Error releasing database connection: {e}")
+            wait = self._budget_wait(lane, route)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._budget_wait(lane, route)
+            yield
+        finally:
+            self._release(lane)
+
+    def _release(self, lane):
+        self._active[lane] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        for lane in self.LANES:
+            queue_ = self._queues[lane]
+            while queue_ and self._active[lane] < self.concurrency[lane]:
+                waiter = queue_.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    self._active[lane] += 1
+            if queue_:
+                # 上位レーンが詰まっている間は下位レーンを開始しない
+                break
+
+    def _budget_wait(self, lane, route):
+        now = time.monotonic()
+        wait = self._global_reset_at - now
+        bucket = self._buckets.get(route) if route else None
+        if bucket is not None:
+            remaining, reset_at = bucket
+            if remaining <= self.reserve[lane]:
+                wait = max(wait, reset_at - now)
+        return wait
+
+
+rest_scheduler = RestScheduler(
+    concurrency={
+        "interactive": REST_INTERACTIVE_CONCURRENCY,
+        "reaction": REST_REACTION_CONCURRENCY,
+        "background": REST_BACKGROUND_CONCURRENCY,
+    },
+    reserve={"interactive": 0, "reaction": 1, "background": REST_BACKGROUND_RESERVE},
+)
+
+DISCORD_REST_QUEUE_DEPTH = Gauge(
+    "discord_rest_queue_depth", "REST calls waiting for a scheduler slot, per lane.",
+    rest_scheduler.queue_depths, ("lane",)
+)
+DISCORD_REST_ACTIVE = Gauge(
+    "discord_rest_active", "REST calls currently holding a scheduler slot, per lane.",
+    rest_scheduler.active_counts, ("lane",)
+)
+
+
+########################
+# DB接続プール
+########################
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# 通常クエリ1本あたりのタイムアウト(秒)
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "10"))
+# 一括保存・カタログ読み込み・マイグレーションなど重いクエリのタイムアウト(秒)
+DB_BULK_TIMEOUT = float(os.getenv("DB_BULK_TIMEOUT", "300"))
+# 接続ごとにキャッシュするプリペアドステートメント数(pgbouncer の transaction モードでは 0 にする)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# ローカルのPostgresに繋ぐ場合は "disable"
+DB_SSL = os.getenv("DB_SSL", "require")
 
+# DBアクセスで捕捉する例外
+DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
 
-def initialize_db():
-    conn = get_db_connection()
-    if not conn:
+db_pool = None
+
+
+async def init_db_pool():
+    global db_pool
+    try:
+        db_pool = await asyncpg.create_pool(
+            dsn=DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_QUERY_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            ssl=None if DB_SSL == "disable" else DB_SSL
+        )
+        logger.info("Database connection pool initialized.")
+    except DB_ERRORS as e:
+        logger.error(f"Database connection pool initialization error: {e}")
+        db_pool = None
+    return db_pool is not None
+
+
+async def close_db_pool():
+    global db_pool
+    if db_pool:
+        await db_pool.close()
+        db_pool = None
+        logger.info("Closed all database connections.")
+
+
+def get_db_pool():
+    if db_pool is None:
+        # DBに繋がるまでの間はキューのフラッシュなどから毎秒呼ばれるので間引く
+        hot_log.log(logging.ERROR, "db_pool_missing", "Database connection pool is not initialized.")
+    return db_pool
+
+
+async def connect_db():
+    """
+    DBに繋がるまで再試行し、繋がったらテーブルを初期化してDB由来の状態を読み込む。
+    それまではスナップショットから復元したカタログで読み取りだけに応答し、書き込みはキューに溜めておく。
+    """
+    delay = 1
+    while not await init_db_pool():
+        logger.warning(f"Database unavailable, serving from snapshot; retrying in {delay:.0f}s.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, DB_RECONNECT_MAX_DELAY)
+    await initialize_db()
+    await load_roulette_threads()
+    await load_panel_messages()
+    await cluster.start()
+    await recommendation_history.load()
+    await load_message_catalogs()
+
+
+@db_timed
+async def initialize_db():
+    global pg_trgm_available
+    pool = get_db_pool()
+    if not pool:
         return
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                message_id BIGINT NOT NULL UNIQUE,
-                thread_id BIGINT NOT NULL,
-                author_id BIGINT NOT NULL,
-                reactions JSONB DEFAULT '{}',
-                content TEXT
-            )
-            """)
-            conn.commit()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if await conn.fetchval("SELECT to_regclass('messages')") is None:
+                    await conn.execute(MESSAGES_DDL)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS message_reactions (
+                    message_id BIGINT NOT NULL,
+                    emoji_id BIGINT NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    PRIMARY KEY (message_id, emoji_id, user_id)
+                )
+                """)
+                await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_message_reactions_user
+                ON message_reactions (user_id, emoji_id, message_id)
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    name TEXT PRIMARY KEY,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    thread_id BIGINT PRIMARY KEY,
+                    last_message_id BIGINT,
+                    last_full_sync_at TIMESTAMPTZ
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS roulette_threads (
+                    thread_id BIGINT PRIMARY KEY,
+                    guild_id BIGINT,
+                    panel_channel_id BIGINT,
+                    added_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS range_checksums (
+                    thread_id BIGINT NOT NULL,
+                    range_start BIGINT NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    checksum BIGINT NOT NULL,
+                    verified_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (thread_id, range_start)
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS author_stats (
+                    thread_id BIGINT NOT NULL,
+                    author_id BIGINT NOT NULL,
+                    post_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (thread_id, author_id)
+                )
+                """)
+                await conn.execute("CREATE INDEX IF NOT EXISTS idx_author_stats_top ON author_stats (thread_id, post_count DESC)")
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS reaction_counts (
+                    message_id BIGINT NOT NULL,
+                    emoji_id BIGINT NOT NULL,
+                    thread_id BIGINT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (message_id, emoji_id)
+                )
+                """)
+                await conn.execute("CREATE INDEX IF NOT EXISTS idx_reaction_counts_top ON reaction_counts (thread_id, emoji_id, count DESC)")
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_reaction_counts (
+                    user_id BIGINT NOT NULL,
+                    thread_id BIGINT NOT NULL,
+                    emoji_id BIGINT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, thread_id, emoji_id)
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS author_names (
+                    author_id BIGINT PRIMARY KEY,
+                    display_name TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS panel_messages (
+                    channel_id BIGINT PRIMARY KEY,
+                    message_id BIGINT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS recommendation_history (
+                    user_id BIGINT PRIMARY KEY,
+                    message_ids BYTEA NOT NULL,
+                    author_ids BYTEA NOT NULL,
+                    shown_at BYTEA NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS backfill_state (
+                    thread_id BIGINT PRIMARY KEY,
+                    before_message_id BIGINT,
+                    processed BIGINT NOT NULL DEFAULT 0,
+                    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    completed_at TIMESTAMPTZ
+                )
+                """)
+                await run_migrations(conn)
+            await run_migrations(conn, optional=True)
+            pg_trgm_available = bool(await conn.fetchval("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"))
         logger.info("Database initialized successfully.")
-    except Error as e:
+    except DB_ERRORS as e:
         logger.error(f"Error initializing tables: {e}")
-    finally:
-        release_db_connection(conn)
 
 
-initialize_db()
+# messages は thread_id のハッシュでパーティション分割する。スレッドを追加してもDDLは不要で、
+# thread_id を条件に含むクエリは1パーティションだけを見る
+MESSAGES_PARTITIONS = 8
+MESSAGES_DDL = """
+    CREATE TABLE messages (
+        message_id BIGINT NOT NULL,
+        thread_id BIGINT NOT NULL,
+        author_id BIGINT NOT NULL,
+        reactions JSONB DEFAULT '{}',
+        content TEXT,
+        deleted_at TIMESTAMPTZ,
+        CONSTRAINT messages_thread_message_pkey PRIMARY KEY (thread_id, message_id)
+    ) PARTITION BY HASH (thread_id);
+""" + "".join(
+    f"CREATE TABLE messages_p{i} PARTITION OF messages FOR VALUES WITH (MODULUS {MESSAGES_PARTITIONS}, REMAINDER {i});\n"
+    for i in range(MESSAGES_PARTITIONS)
+) + """
+    CREATE INDEX idx_messages_thread ON messages (thread_id, message_id, author_id);
+    CREATE INDEX idx_messages_thread_author ON messages (thread_id, author_id);
+    CREATE INDEX idx_messages_message ON messages (message_id);
+"""
+
+
+async def run_migrations(conn, optional=False):
+    """
+    未適用のマイグレーションを順に実行する。
+    optional=False では OPTIONAL_MIGRATIONS 以外を、呼び出し側のトランザクション内で実行する。
+    optional=True では OPTIONAL_MIGRATIONS を1件ずつ別のトランザクションで実行し、失敗しても次回の起動で再試行する。
+    """
+    for name, sql in MIGRATIONS:
+        if (name in OPTIONAL_MIGRATIONS) != optional:
+            continue
+        if await conn.fetchval("SELECT 1 FROM schema_migrations WHERE name = $1", name):
+            continue
+        try:
+            async with conn.transaction():
+                await conn.execute(sql, timeout=DB_BULK_TIMEOUT)
+                await conn.execute("INSERT INTO schema_migrations (name) VALUES ($1)", name)
+        except asyncpg.PostgresError as e:
+            if not optional:
+                raise
+            logger.warning(f"Skipped optional migration {name}: {e}")
+            continue
+        logger.info(f"Applied migration {name}.")
+
+
+# 拡張機能の作成など、権限によっては失敗してよいマイグレーション
+OPTIONAL_MIGRATIONS = {"0005_messages_content_trgm"}
+# pg_trgm が使えるか。使えなければ /search は索引なしの ILIKE で新しい順に返す
+pg_trgm_available = False
+
+
+MIGRATIONS = [
+    # messages.reactions (JSONB) から message_reactions への一回限りの移行
+    ("0001_reactions_jsonb_to_table", """
+        INSERT INTO message_reactions (message_id, emoji_id, user_id)
+        SELECT m.message_id, e.key::BIGINT, u.value::BIGINT
+        FROM messages m
+        CROSS JOIN LATERAL jsonb_each(
+            CASE WHEN jsonb_typeof(m.reactions) = 'object' THEN m.reactions ELSE '{}'::JSONB END
+        ) AS e
+        CROSS JOIN LATERAL jsonb_array_elements_text(
+            CASE WHEN jsonb_typeof(e.value) = 'array' THEN e.value ELSE '[]'::JSONB END
+        ) AS u
+        WHERE e.key ~ '^[0-9]+$' AND u.value ~ '^[0-9]+$'
+        ON CONFLICT DO NOTHING
+    """),
+    # 削除済みメッセージを行を残したまま墓標として記録する
+    ("0002_messages_deleted_at", """
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ
+    """),
+    # 単一テーブルの messages を thread_id でパーティション分割したテーブルへ移す
+    ("0003_partition_messages_by_thread", f"""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass) THEN
+                ALTER TABLE messages RENAME TO messages_unpartitioned;
+                DROP INDEX IF EXISTS idx_messages_thread;
+                {MESSAGES_DDL}
+                INSERT INTO messages (message_id, thread_id, author_id, reactions, content, deleted_at)
+                SELECT message_id, thread_id, author_id, reactions, content, deleted_at FROM messages_unpartitioned;
+                DROP TABLE messages_unpartitioned;
+            END IF;
+        END
+        $$
+    """),
+    # /stats・/mystats 用の集計テーブルを既存データから作り直す。以後は書き込みと同じ文で更新される
+    ("0004_stats_counters", """
+        TRUNCATE author_stats, reaction_counts, user_reaction_counts;
+        INSERT INTO author_stats (thread_id, author_id, post_count)
+        SELECT thread_id, author_id, count(*) FROM messages
+        WHERE deleted_at IS NULL
+        GROUP BY thread_id, author_id;
+        INSERT INTO reaction_counts (message_id, emoji_id, thread_id, count)
+        SELECT r.message_id, r.emoji_id, m.thread_id, count(*)
+        FROM message_reactions r JOIN messages m ON m.message_id = r.message_id
+        GROUP BY r.message_id, r.emoji_id, m.thread_id;
+        INSERT INTO user_reaction_counts (user_id, thread_id, emoji_id, count)
+        SELECT r.user_id, m.thread_id, r.emoji_id, count(*)
+        FROM message_reactions r JOIN messages m ON m.message_id = r.message_id
+        GROUP BY r.user_id, m.thread_id, r.emoji_id;
+    """),
+    # /search 用。ILIKE の部分一致を索引で引けるよう、本文にトライグラムの GIN インデックスを張る
+    ("0005_messages_content_trgm", """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS idx_messages_content_trgm ON messages USING gin (content gin_trgm_ops);
+    """),
+]
+
+
+########################
+# プロセス間の連携
+########################
+# 他プロセスとの変更通知に使う LISTEN/NOTIFY のチャンネル名と、同期ループのリーダーを決める advisory lock のキー
+NOTIFY_CHANNEL = "manga_bot_changes"
+SYNC_LEADER_LOCK_KEY = 0x6D616E6761
+# NOTIFY のペイロードは 8000 バイトまでなので、1通知あたりの件数を抑える
+NOTIFY_CHUNK = 100
+# 自分が送った通知を読み飛ばすための識別子
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ClusterCoordinator:
+    """
+    CLUSTER_MODE で複数プロセスを動かすときの調整役。
+    専用の接続で他プロセスの変更通知を LISTEN してカタログなどに反映し、
+    同じ接続のセッションで advisory lock を取れたプロセスだけを同期ループのリーダーにする。
+    接続が切れるとロックも外れるので、別のプロセスがリーダーを引き継ぐ。
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._leader = False
+        self._closing = False
+        self._reconnect_task = None
+
+    async def start(self):
+        if not CLUSTER_MODE:
+            return
+        self._closing = False
+        await self._connect()
+
+    async def stop(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._leader = False
+            await conn.close()
+
+    async def is_leader(self):
+        if not CLUSTER_MODE:
+            return True
+        if self._conn is None:
+            return False
+        if not self._leader:
+            try:
+                self._leader = await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", SYNC_LEADER_LOCK_KEY)
+            except DB_ERRORS as e:
+                logger.error(f"Error acquiring sync leadership: {e}")
+                return False
+            if self._leader:
+                logger.info("Acquired sync leadership.")
+        return self._leader
+
+    async def _connect(self):
+        try:
+            conn = await asyncpg.connect(dsn=DATABASE_URL, ssl=None if DB_SSL == "disable" else DB_SSL)
+            await conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+        except DB_ERRORS as e:
+            logger.error(f"Could not open cluster coordination connection: {e}")
+            self._schedule_reconnect()
+            return False
+        conn.add_termination_listener(self._on_terminate)
+        self._conn = conn
+        logger.info(f"Listening for cluster notifications as {INSTANCE_ID}.")
+        return True
+
+    def _on_terminate(self, conn):
+        if conn is not self._conn:
+            return
+        self._conn = None
+        if self._leader:
+            logger.warning("Lost sync leadership: coordination connection closed.")
+        self._leader = False
+        if not self._closing:
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while not self._closing:
+            await asyncio.sleep(delay)
+            if await self._connect():
+                # 切断中の通知は届いていないので、カタログを読み直す
+                await reload_message_catalogs()
+                return
+            delay = min(delay * 2, 60)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Ignoring malformed cluster notification: {payload[:200]}")
+            return
+        if data.get("o") == INSTANCE_ID:
+            return
+        apply_remote_changes(data)
+
+
+cluster = ClusterCoordinator()
+
+
+async def publish_changes(conn, messages=(), reactions=(), deletes=(), **flags):
+    """
+    他プロセスへ変更を通知する。トランザクション内で呼べば、コミットされたときにだけ届く。
+    messages は (message_id, thread_id, author_id)、reactions は (message_id, emoji_id, user_id, add)。
+    """
+    if not CLUSTER_MODE:
+        return
+    payloads = []
+    for key, items in (("m", messages), ("r", reactions), ("d", deletes)):
+        items = list(items)
+        for i in range(0, len(items), NOTIFY_CHUNK):
+            payloads.append({"o": INSTANCE_ID, key: items[i:i + NOTIFY_CHUNK]})
+    if flags:
+        payloads.append({"o": INSTANCE_ID, **flags})
+    if payloads:
+        await conn.executemany(
+            "SELECT pg_notify($1, $2)",
+            [(NOTIFY_CHANNEL, json.dumps(payload, separators=(",", ":"))) for payload in payloads]
+        )
+
+
+def apply_remote_changes(data):
+    """他プロセスが書き込んだ変更を、このプロセスのカタログ・パネル情報に反映する。"""
+    for message_id, thread_id, author_id in data.get("m", ()):
+        message_catalog = message_catalogs.get(thread_id)
+        if message_catalog is not None:
+            message_catalog.add_message(message_id, author_id)
+    for message_id in data.get("d", ()):
+        for message_catalog in message_catalogs.values():
+            if message_id in message_catalog:
+                message_catalog.remove_message(message_id)
+    for message_id, emoji_id, user_id, add in data.get("r", ()):
+        for message_catalog in message_catalogs.values():
+            if message_id in message_catalog:
+                message_catalog.apply_reaction(message_id, emoji_id, user_id, add)
+                break
+    if "panel" in data:
+        channel_id, message_id = data["panel"]
+        panel_messages[channel_id] = message_id
+    if data.get("threads"):
+        asyncio.create_task(reload_roulette_threads())
 
 
 ########################
@@ -141,13 +1071,82 @@ intents.guilds = True
 intents.members = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+def parse_shard_ids(value):
+    ids = []
+    for part in value.split(","):
+        start, _, end = part.strip().partition("-")
+        ids.extend(range(int(start), int(end or start) + 1))
+    return ids
+
+
+def shard_options():
+    options = {}
+    if SHARD_COUNT:
+        options["shard_count"] = int(SHARD_COUNT)
+    if SHARD_IDS:
+        options["shard_ids"] = parse_shard_ids(SHARD_IDS)
+    return options
+
+
+class MangaBot(commands.AutoShardedBot):
+
+    # SIGTERM で始めた close() のタスクと、setup_hook で始めるDB接続のタスク
+    close_task = None
+    db_task = None
+
+    async def setup_hook(self):
+        # DBの準備はゲートウェイ接続を待たせないよう裏で行い、その間はスナップショットで応答する
+        self.metrics_server = await start_metrics_server()
+        # Heroku は dyno を SIGTERM で止める。run() は KeyboardInterrupt しか扱わないので、
+        # ここで close() を呼んでキューの書き切り・履歴・スナップショットの保存を行う
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._on_sigterm)
+        restore_snapshot()
+        reaction_queue.start()
+        self.db_task = asyncio.create_task(connect_db())
+
+    def _on_sigterm(self):
+        logger.info("Received SIGTERM, shutting down.")
+        if self.close_task is None:
+            self.close_task = asyncio.create_task(self.close())
+
+    async def start(self, *args, **kwargs):
+        await super().start(*args, **kwargs)
+        # ゲートウェイが閉じると start() は戻るが、close() の残りの後始末は別タスクで続いている。
+        # run() が残りのタスクを取り消す前に書き切りを待つ
+        if self.close_task is not None:
+            await self.close_task
+
+    async def close(self):
+        await super().close()
+        # ログインに失敗した場合は setup_hook が呼ばれず、db_task も無い
+        if self.db_task is not None:
+            self.db_task.cancel()
+        await author_names.stop()
+        await recommendation_history.flush()
+        await reaction_queue.stop()
+        await save_snapshot()
+        await cluster.stop()
+        await close_db_pool()
+
+
+bot = MangaBot(command_prefix="!", intents=intents, http_trace=make_http_trace(), **shard_options())
 
 
 ########################
 # ヘルパー変数・関数
 ########################
-last_chosen_authors = {}
+async def resolve_channel(channel_id):
+    """キャッシュに無いチャンネル(他のシャードが受け持つギルドのもの)は REST で取得する。"""
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        try:
+            async with rest_scheduler.slot("background", "GET /channels/:id"):
+                channel = await bot.fetch_channel(channel_id)
+        except discord.HTTPException as e:
+            logger.error(f"Error fetching channel {channel_id}: {e}")
+            return None
+    return channel
 
 
 async def safe_fetch_message(channel, message_id):
@@ -157,161 +1156,1522 @@ async def safe_fetch_message(channel, message_id):
         return None
 
 
-async def ensure_message_in_db(message):
-    if not message:
-        return
+@db_timed
+async def fetch_reactions(msg_id):
+    """
+    対象メッセージのリアクションをDBから取得するヘルパー関数。
+    メッセージがDBに無ければ None、あれば {emoji_id: [user_id, ...]} を返す。
+    """
+    pool = get_db_pool()
+    if not pool:
+        return None
     try:
-        await asyncio.to_thread(_ensure_message_in_db_sync, message)
-    except Exception as e:
-        logger.error(f"Error ensuring message in DB: {e}")
+        rows = await pool.fetch("""
+            SELECT r.emoji_id, r.user_id
+            FROM messages m
+            LEFT JOIN message_reactions r ON r.message_id = m.message_id
+            WHERE m.message_id = $1
+            ORDER BY r.emoji_id, r.user_id
+        """, msg_id)
+    except DB_ERRORS as e:
+        logger.error(f"Error fetching reactions for message_id={msg_id}: {e}")
+        raise
+    if not rows:
+        return None
 
+    r = {}
+    for emoji_id, user_id in rows:
+        if emoji_id is not None:
+            r.setdefault(emoji_id, []).append(user_id)
+    return r
 
-def _ensure_message_in_db_sync(message):
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT id FROM messages WHERE message_id = %s", (message.id,))
-            row = cur.fetchone()
-            if row:
-                return
-            cur.execute("""
-                INSERT INTO messages (message_id, thread_id, author_id, content)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT DO NOTHING
-            """, (message.id, message.channel.id, message.author.id, message.content))
-            conn.commit()
-            logger.info(f"Inserted new message into DB (message_id={message.id}).")
-    except Error as e:
-        logger.error(f"Error ensuring message in DB: {e}")
-    finally:
-        release_db_connection(conn)
+
+# /stats で表示する件数
+STATS_TOP_N = 5
 
 
-async def update_reactions_in_db(message_id, emoji_id, user_id, add=True):
+@db_timed
+async def fetch_thread_stats(thread_id, limit=STATS_TOP_N):
+    """
+    スレッドのお気に入りが多い投稿と投稿が多い作者を、集計テーブルから上位 limit 件ずつ返す。
+    ([(message_id, count), ...], [(author_id, post_count), ...]) の形。DBが使えなければ None。
+    """
+    pool = get_db_pool()
+    if not pool:
+        return None
     try:
-        await asyncio.to_thread(_update_reactions_in_db_sync, message_id, emoji_id, user_id, add)
-    except Exception as e:
-        logger.error(f"Error updating reactions in DB: {e}")
+        async with pool.acquire() as conn:
+            favorites = await conn.fetch("""
+                SELECT message_id, count FROM reaction_counts
+                WHERE thread_id = $1 AND emoji_id = $2 AND count > 0
+                ORDER BY count DESC LIMIT $3
+            """, thread_id, FAVORITE_REACTION_ID, limit)
+            authors = await conn.fetch("""
+                SELECT author_id, post_count FROM author_stats
+                WHERE thread_id = $1 AND post_count > 0
+                ORDER BY post_count DESC LIMIT $2
+            """, thread_id, limit)
+    except DB_ERRORS as e:
+        logger.error(f"Error fetching stats for thread {thread_id}: {e}")
+        return None
+    return [tuple(row) for row in favorites], [tuple(row) for row in authors]
 
 
-def _update_reactions_in_db_sync(message_id, emoji_id, user_id, add=True):
-    conn = get_db_connection()
-    if not conn:
-        return
+@db_timed
+async def fetch_user_stats(user_id, thread_id):
+    """ユーザーがスレッドで付けているリアクションの数を {emoji_id: count} で返す。DBが使えなければ None。"""
+    pool = get_db_pool()
+    if not pool:
+        return None
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT reactions FROM messages WHERE message_id = %s", (message_id,))
-            row = cur.fetchone()
-            if not row:
-                logger.info(f"No row found for message_id={message_id}, skip reaction update.")
-                return
-            reactions = row["reactions"] or {}
-            if isinstance(reactions, str):
-                try:
-                    reactions = json.loads(reactions)
-                except json.JSONDecodeError:
-                    reactions = {}
+        rows = await pool.fetch("""
+            SELECT emoji_id, count FROM user_reaction_counts
+            WHERE user_id = $1 AND thread_id = $2
+        """, user_id, thread_id)
+    except DB_ERRORS as e:
+        logger.error(f"Error fetching stats for user {user_id}: {e}")
+        return None
+    return {row["emoji_id"]: row["count"] for row in rows}
 
-            str_emoji_id = str(emoji_id)
-            user_list = reactions.get(str_emoji_id, [])
 
-            if add:
-                if user_id not in user_list:
-                    user_list.append(user_id)
-            else:
-                if user_id in user_list:
-                    user_list.remove(user_id)
-
-            reactions[str_emoji_id] = user_list
-            new_json = json.dumps(reactions)
-            cur.execute("""
-                UPDATE messages
-                SET reactions = %s
-                WHERE message_id = %s
-            """, (new_json, message_id))
-            conn.commit()
-            logger.info(f"Reactions updated for message_id={message_id}.")
-    except Error as e:
-        logger.error(f"Error updating reactions in DB: {e}")
-    finally:
-        release_db_connection(conn)
+# 1回の検索で使う語の上限
+SEARCH_MAX_TERMS = 8
 
 
-def user_reacted(msg, reaction_id, user_id):
-    reaction_data = msg.get("reactions", {})
-    if isinstance(reaction_data, str):
-        try:
-            reaction_data = json.loads(reaction_data)
-        except json.JSONDecodeError:
-            reaction_data = {}
-    return user_id in reaction_data.get(str(reaction_id), [])
+def search_terms(query):
+    """空白区切りの検索語を、ILIKE のワイルドカードをエスケープしたパターンにする。"""
+    terms = query.split()[:SEARCH_MAX_TERMS]
+    return ["%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for t in terms]
+
 
+def _search_conditions(patterns, first_param):
+    # すべての語を含む投稿。各 ILIKE がトライグラムの索引で絞り込まれる
+    return " AND ".join(f"content ILIKE ${first_param + i}" for i in range(len(patterns)))
 
-def _fetch_reactions_sync(msg_id):
+
+@db_timed
+async def search_messages(thread_id, query, limit, offset=0):
     """
-    対象メッセージのリアクションをDBから同期的に取得するヘルパー関数。
+    スレッドの未削除の投稿から query の語をすべて含むものを、語との近さ順(pg_trgm が無ければ新しい順)に返す。
+    [{"message_id", "author_id", "content"}, ...] の形。DBが使えなければ None。
     """
-    conn = get_db_connection()
-    if not conn:
+    pool = get_db_pool()
+    if not pool:
         return None
+    patterns = search_terms(query)
+    params = [thread_id, limit, offset, *patterns]
+    order = "message_id DESC"
+    if pg_trgm_available:
+        params.append(query)
+        order = f"word_similarity(${len(params)}, content) DESC, {order}"
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT reactions FROM messages WHERE message_id = %s", (msg_id,))
-            row = cur.fetchone()
-            if not row:
-                return None
-
-            r = row["reactions"] or {}
-            if isinstance(r, str):
-                try:
-                    r = json.loads(r)
-                except json.JSONDecodeError:
-                    r = {}
-            return r
-    except Error as e:
-        logger.error(f"Error fetching reactions for message_id={msg_id}: {e}")
+        rows = await pool.fetch(f"""
+            SELECT message_id, author_id, content FROM messages
+            WHERE thread_id = $1 AND deleted_at IS NULL AND {_search_conditions(patterns, 4)}
+            ORDER BY {order}
+            LIMIT $2 OFFSET $3
+        """, *params)
+    except DB_ERRORS as e:
+        logger.error(f"Error searching thread {thread_id}: {e}")
         return None
-    finally:
-        release_db_connection(conn)
+    return [dict(row) for row in rows]
 
 
-async def get_random_message(thread_id, filter_func=None, button_name="N/A"):
+@db_timed
+async def pick_search_match(thread_id, query, exclude_messages=()):
+    """検索に当たる投稿から1件をランダムに選ぶ。"""
+    pool = get_db_pool()
+    if not pool:
+        return None
+    patterns = search_terms(query)
     try:
-        return await asyncio.to_thread(_get_random_message_sync, thread_id, filter_func, button_name)
-    except Exception as e:
-        logger.error(f"Error getting random message: {e}")
+        row = await pool.fetchrow(f"""
+            SELECT message_id, author_id FROM messages
+            WHERE thread_id = $1 AND deleted_at IS NULL AND message_id <> ALL($2::BIGINT[])
+              AND {_search_conditions(patterns, 3)}
+            ORDER BY random() LIMIT 1
+        """, thread_id, list(exclude_messages), *patterns)
+    except DB_ERRORS as e:
+        logger.error(f"Error picking search match in thread {thread_id}: {e}")
         return None
+    return dict(row) if row else None
 
 
-def _get_random_message_sync(thread_id, filter_func=None, button_name="N/A"):
-    conn = get_db_connection()
-    if not conn:
-        return None
+########################
+# 一括取り込み
+########################
+async def insert_messages(conn, rows, method=None):
+    """
+    (message_id, thread_id, author_id, content) の列を messages へ取り込み、新規に入った件数を返す。
+    既存の message_id は ON CONFLICT で無視する。トランザクション内で呼ぶこと。
+    """
+    if not rows:
+        return 0
+    method = method or ("copy" if len(rows) >= BULK_COPY_THRESHOLD else "values")
+    if method == "copy":
+        await conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS messages_staging (
+                message_id BIGINT, thread_id BIGINT, author_id BIGINT, content TEXT
+            ) ON COMMIT DELETE ROWS
+        """)
+        await conn.copy_records_to_table("messages_staging", records=rows, timeout=DB_BULK_TIMEOUT)
+        source = "messages_staging"
+        args = ()
+    else:
+        source = "unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[], $4::TEXT[])"
+        args = tuple(zip(*rows))
+    return await conn.fetchval(_with_post_counts(f"""
+        INSERT INTO messages (message_id, thread_id, author_id, content)
+        SELECT a.message_id, a.thread_id, a.author_id, a.content
+        FROM {source} AS a(message_id, thread_id, author_id, content)
+        ON CONFLICT DO NOTHING
+        RETURNING thread_id, author_id
+    """, 1), *args, timeout=DB_BULK_TIMEOUT)
+
+
+async def insert_reactions(conn, rows, method=None):
+    """
+    (message_id, emoji_id, user_id) の列を message_reactions へ取り込み、新規に入った件数を返す。
+    DBに存在しないメッセージや削除済みのメッセージへのリアクションは無視する。トランザクション内で呼ぶこと。
+    """
+    if not rows:
+        return 0
+    method = method or ("copy" if len(rows) >= BULK_COPY_THRESHOLD else "values")
+    if method == "copy":
+        await conn.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS message_reactions_staging (
+                message_id BIGINT, emoji_id BIGINT, user_id BIGINT
+            ) ON COMMIT DELETE ROWS
+        """)
+        await conn.copy_records_to_table("message_reactions_staging", records=rows, timeout=DB_BULK_TIMEOUT)
+        source = "message_reactions_staging"
+        args = ()
+    else:
+        source = "unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[])"
+        args = tuple(zip(*rows))
+    return await conn.fetchval(_with_reaction_counts(f"""
+        INSERT INTO message_reactions (message_id, emoji_id, user_id)
+        SELECT a.message_id, a.emoji_id, a.user_id
+        FROM {source} AS a(message_id, emoji_id, user_id)
+        WHERE EXISTS (SELECT 1 FROM messages m WHERE m.message_id = a.message_id AND m.deleted_at IS NULL)
+        ON CONFLICT DO NOTHING
+        RETURNING message_id, emoji_id, user_id
+    """, 1), *args, timeout=DB_BULK_TIMEOUT)
+
+
+# 集計テーブル(author_stats / reaction_counts / user_reaction_counts)は、
+# 元の行を書き換える文と同じ文の CTE で差分を足し込む。/stats と /mystats は数行の索引検索で済む
+def _with_post_counts(changed_sql, sign, result="SELECT count(*) FROM changed"):
+    """changed_sql は (thread_id, author_id) を RETURNING する INSERT / UPDATE。"""
+    return f"""
+        WITH changed AS ({changed_sql}),
+        counted AS (
+            INSERT INTO author_stats AS s (thread_id, author_id, post_count)
+            SELECT thread_id, author_id, {sign} * count(*) FROM changed GROUP BY thread_id, author_id
+            ON CONFLICT (thread_id, author_id) DO UPDATE SET post_count = s.post_count + EXCLUDED.post_count
+        )
+        {result}
+    """
+
+
+def _with_reaction_counts(changed_sql, sign):
+    """changed_sql は (message_id, emoji_id, user_id) を RETURNING する INSERT / DELETE。"""
+    return f"""
+        WITH changed AS ({changed_sql}),
+        located AS (
+            SELECT c.message_id, c.emoji_id, c.user_id, m.thread_id
+            FROM changed c JOIN messages m ON m.message_id = c.message_id
+        ),
+        per_message AS (
+            INSERT INTO reaction_counts AS s (message_id, emoji_id, thread_id, count)
+            SELECT message_id, emoji_id, thread_id, {sign} * count(*) FROM located GROUP BY message_id, emoji_id, thread_id
+            ON CONFLICT (message_id, emoji_id) DO UPDATE SET count = s.count + EXCLUDED.count
+        ),
+        per_user AS (
+            INSERT INTO user_reaction_counts AS s (user_id, thread_id, emoji_id, count)
+            SELECT user_id, thread_id, emoji_id, {sign} * count(*) FROM located GROUP BY user_id, thread_id, emoji_id
+            ON CONFLICT (user_id, thread_id, emoji_id) DO UPDATE SET count = s.count + EXCLUDED.count
+        )
+        SELECT count(*) FROM changed
+    """
+
+
+async def delete_reactions(conn, rows):
+    """(message_id, emoji_id, user_id) の列を message_reactions から消し、消えた件数を返す。"""
+    if not rows:
+        return 0
+    return await conn.fetchval(_with_reaction_counts("""
+        DELETE FROM message_reactions r
+        USING unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[]) AS d(message_id, emoji_id, user_id)
+        WHERE r.message_id = d.message_id AND r.emoji_id = d.emoji_id AND r.user_id = d.user_id
+        RETURNING r.message_id, r.emoji_id, r.user_id
+    """, -1), *zip(*rows))
+
+
+async def tombstone_messages(conn, condition, *args):
+    """
+    condition に当たる未削除のメッセージに deleted_at を付け、そのリアクションを消す。
+    新たに削除扱いにした message_id のリストを返す。
+    """
+    rows = await conn.fetch(_with_post_counts(f"""
+        UPDATE messages SET deleted_at = now()
+        WHERE deleted_at IS NULL AND {condition}
+        RETURNING message_id, thread_id, author_id
+    """, -1, "SELECT message_id FROM changed"), *args)
+    message_ids = [row["message_id"] for row in rows]
+    if message_ids:
+        await conn.fetchval(_with_reaction_counts("""
+            DELETE FROM message_reactions WHERE message_id = ANY($1::BIGINT[])
+            RETURNING message_id, emoji_id, user_id
+        """, -1), message_ids)
+    return message_ids
+
+
+########################
+# リアクション書き込みキュー
+########################
+class ReactionWriteQueue:
+    """
+    メッセージの追加・編集・削除とリアクションの追加・削除をメモリに溜め、
+    一定間隔または一定件数でまとめてDBへ書き込むキュー。
+    同じ (message, emoji, user) の追加→削除(削除→追加)は書き込み前に打ち消し合う。
+    """
+
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._messages = {}
+        self._edits = {}
+        self._deletes = set()
+        self._ops = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = None
+
+    def __len__(self):
+        return len(self._ops) + len(self._messages) + len(self._edits) + len(self._deletes)
+
+    def put_message(self, message):
+        """リアクションより先に messages へ保存すべきメッセージを積む。"""
+        self._messages[message.id] = (message.id, message.channel.id, message.author.id, message.content)
+        self._maybe_wakeup()
+
+    def put_edit(self, message_id, content):
+        row = self._messages.get(message_id)
+        if row is not None:
+            self._messages[message_id] = row[:3] + (content,)
+        else:
+            self._edits[message_id] = content
+        self._maybe_wakeup()
+
+    def put_delete(self, message_ids):
+        for message_id in message_ids:
+            self._messages.pop(message_id, None)
+            self._edits.pop(message_id, None)
+            self._deletes.add(message_id)
+        self._maybe_wakeup()
+
+    def put(self, message_id, emoji_id, user_id, add=True):
+        self._merge((message_id, emoji_id, user_id), add)
+        self._maybe_wakeup()
+
+    def _merge(self, key, add):
+        # Discordは状態が変わったときだけイベントを送るため、逆向きの操作が来たら差し引きゼロになる
+        pending = self._ops.get(key)
+        if pending is None:
+            self._ops[key] = add
+        elif pending != add:
+            del self._ops[key]
+
+    def _maybe_wakeup(self):
+        if len(self) >= self.max_pending:
+            self._wakeup.set()
+
+    def dump(self):
+        """未書き込みの操作を JSON にできる形で返す。"""
+        return {
+            "messages": list(self._messages.values()),
+            "edits": list(self._edits.items()),
+            "deletes": list(self._deletes),
+            "ops": [(*key, add) for key, add in self._ops.items()],
+        }
+
+    def replay(self, message_catalog, thread_id):
+        """まだDBに書けていない操作を、DBから読み直したカタログに当て直す。"""
+        for message_id, row_thread_id, author_id, _ in self._messages.values():
+            if row_thread_id == thread_id:
+                message_catalog.add_message(message_id, author_id)
+        for message_id in self._deletes:
+            if message_id in message_catalog:
+                message_catalog.remove_message(message_id)
+        for (message_id, emoji_id, user_id), add in self._ops.items():
+            message_catalog.apply_reaction(message_id, emoji_id, user_id, add)
+
+    def restore(self, data):
+        """dump() の結果を、いま溜まっている操作より前にあったものとして積み直す。"""
+        for row in data["messages"]:
+            self._messages.setdefault(row[0], tuple(row))
+        for message_id, content in data["edits"]:
+            self._edits.setdefault(message_id, content)
+        self._deletes.update(data["deletes"])
+        for message_id, emoji_id, user_id, add in data["ops"]:
+            self._ops.setdefault((message_id, emoji_id, user_id), add)
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ループを止め、溜まっている分を書き切る。"""
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if len(self):
+            logger.error(f"Could not flush {len(self)} pending reaction writes on shutdown.")
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not len(self):
+                return
+            messages, self._messages = self._messages, {}
+            edits, self._edits = self._edits, {}
+            deletes, self._deletes = self._deletes, set()
+            ops, self._ops = self._ops, {}
+            if await write_reaction_batch(list(messages.values()), ops, edits, deletes):
+                return
+            # 失敗した分は、その後に積まれた操作より前にあったものとして戻す
+            newer_messages, newer_edits, newer_deletes, newer_ops = self._messages, self._edits, self._deletes, self._ops
+            self._messages, self._edits, self._deletes, self._ops = messages, edits, deletes, ops
+            for message_id in newer_deletes:
+                self._messages.pop(message_id, None)
+                self._edits.pop(message_id, None)
+            self._messages.update(newer_messages)
+            self._edits.update(newer_edits)
+            self._deletes |= newer_deletes
+            for key, add in newer_ops.items():
+                self._merge(key, add)
+
+
+@db_timed
+async def write_reaction_batch(messages, ops, edits=None, deletes=()):
+    """
+    messages の保存、本文の編集、削除(墓標化)とリアクションの追加・削除を、1トランザクションでまとめて書き込む。
+    削除されたメッセージは deleted_at を付けて行を残し、そのリアクションは消す。
+    """
+    pool = get_db_pool()
+    if not pool:
+        return False
+    edits = edits or {}
+    adds = [key for key, add in ops.items() if add and key[0] not in deletes]
+    removes = [key for key, add in ops.items() if not add]
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await insert_messages(conn, messages)
+                await insert_reactions(conn, adds)
+                await delete_reactions(conn, removes)
+                if edits:
+                    await conn.execute("""
+                        UPDATE messages m SET content = d.content
+                        FROM unnest($1::BIGINT[], $2::TEXT[]) AS d(message_id, content)
+                        WHERE m.message_id = d.message_id AND m.deleted_at IS NULL
+                    """, list(edits), list(edits.values()))
+                if deletes:
+                    await tombstone_messages(conn, "message_id = ANY($1::BIGINT[])", list(deletes))
+                await publish_changes(
+                    conn,
+                    messages=[(message_id, thread_id, author_id) for message_id, thread_id, author_id, _ in messages],
+                    reactions=[(*key, True) for key in adds] + [(*key, False) for key in removes],
+                    deletes=deletes
+                )
+    except DB_ERRORS as e:
+        logger.error(f"Error flushing reaction writes: {e}")
+        return False
+    hot_log.info(
+        "reaction_flush",
+        f"Flushed {len(messages)} messages, {len(edits)} edits, {len(deletes)} deletes, "
+        f"{len(adds)} reaction adds and {len(removes)} removes.",
+        messages=len(messages), edits=len(edits), deletes=len(deletes), adds=len(adds), removes=len(removes)
+    )
+    return True
+
+
+reaction_queue = ReactionWriteQueue(REACTION_FLUSH_INTERVAL, REACTION_FLUSH_MAX_PENDING)
+
+
+########################
+# ルーレットの抽出条件
+########################
+class RouletteFilter:
+    """
+    ボタンごとの抽出条件。
+    メモリ上のカタログ検索にも、1本のSQLクエリにもそのまま変換できる宣言的な表現。
+    """
+
+    __slots__ = ("user_id", "exclude_authors", "exclude_messages", "require_reaction", "forbid_reaction", "strategy")
+
+    def __init__(self, user_id, exclude_authors=(), require_reaction=None, forbid_reaction=None, exclude_messages=(),
+                 strategy="uniform"):
+        self.user_id = user_id
+        self.exclude_authors = frozenset(exclude_authors)
+        self.exclude_messages = frozenset(exclude_messages)
+        self.require_reaction = require_reaction
+        self.forbid_reaction = forbid_reaction
+        self.strategy = strategy
+
+    @classmethod
+    def for_button(cls, button_name, user_id, last_author_id=None, recent_message_ids=()):
+        """
+        自分の投稿・SPECIFIC_EXCLUDE_USER・前回選ばれた作者、
+        および直近におすすめした投稿を除外した条件を作る。
+        """
+        exclude_authors = {user_id, SPECIFIC_EXCLUDE_USER}
+        if last_author_id is not None:
+            exclude_authors.add(last_author_id)
+        return cls(
+            user_id, exclude_authors, exclude_messages=recent_message_ids,
+            strategy=BUTTON_STRATEGIES[button_name], **BUTTON_FILTERS[button_name]
+        )
+
+    def without_recent(self):
+        """直近おすすめの除外だけを外した条件。候補が少なく全て除外されたときに使う。"""
+        return RouletteFilter(
+            self.user_id, self.exclude_authors, self.require_reaction, self.forbid_reaction, strategy=self.strategy
+        )
+
+    def to_sql(self, thread_id):
+        """候補を絞り込む WHERE 句とパラメータ($1, $2, ...)を返す。テーブル別名は m。"""
+        params = [thread_id, list(self.exclude_authors)]
+        clauses = ["m.thread_id = $1", "m.deleted_at IS NULL", "m.author_id <> ALL($2::BIGINT[])"]
+        if self.exclude_messages:
+            params.append(list(self.exclude_messages))
+            clauses.append(f"m.message_id <> ALL(${len(params)}::BIGINT[])")
+        for reaction_id, negate in ((self.require_reaction, False), (self.forbid_reaction, True)):
+            if reaction_id is None:
+                continue
+            params.extend([reaction_id, self.user_id])
+            clauses.append(f"""{"NOT " if negate else ""}EXISTS (
+                SELECT 1 FROM message_reactions r
+                WHERE r.message_id = m.message_id AND r.emoji_id = ${len(params) - 1} AND r.user_id = ${len(params)}
+            )""")
+        return " AND ".join(clauses), params
+
+    def to_sample_query(self, thread_id):
+        """
+        条件に合う1件をサーバー側で選ぶクエリを返す。
+        uniform は ORDER BY random() で全件をソートする代わりに、インデックス上の件数から乱数オフセットを決める。
+        favorites は -ln(u) / 重み が最小の1件(重み付き抽出)、authors は作者を1人選んでからその投稿を選ぶ。
+        """
+        where, params = self.to_sql(thread_id)
+        if self.strategy == "favorites":
+            params.append(FAVORITE_REACTION_ID)
+            query = f"""
+                SELECT m.message_id, m.author_id
+                FROM messages m
+                WHERE {where}
+                ORDER BY -ln(1.0 - random()) / (1 + (
+                    SELECT count(*) FROM message_reactions f
+                    WHERE f.message_id = m.message_id AND f.emoji_id = ${len(params)}
+                ))
+                LIMIT 1
+            """
+        elif self.strategy == "authors":
+            query = f"""
+                SELECT m.message_id, m.author_id
+                FROM messages m
+                WHERE {where} AND m.author_id = (
+                    SELECT a.author_id FROM (SELECT DISTINCT m.author_id FROM messages m WHERE {where}) a
+                    ORDER BY random() LIMIT 1
+                )
+                ORDER BY random()
+                LIMIT 1
+            """
+        else:
+            query = f"""
+                SELECT m.message_id, m.author_id
+                FROM messages m
+                WHERE {where}
+                ORDER BY m.message_id
+                OFFSET (SELECT floor(random() * count(*))::BIGINT FROM messages m WHERE {where})
+                LIMIT 1
+            """
+        return query, params
+
+
+# ボタン名 -> 抽出条件(除外は RouletteFilter.for_button で共通に付与)
+BUTTON_FILTERS = {
+    "blue_random": {},
+    "blue_read_later": {"require_reaction": READ_LATER_REACTION_ID},
+    "blue_favorite": {"require_reaction": FAVORITE_REACTION_ID},
+    "red_random": {"forbid_reaction": RANDOM_EXCLUDE_ID},
+    "red_read_later": {"require_reaction": READ_LATER_REACTION_ID, "forbid_reaction": RANDOM_EXCLUDE_ID},
+}
+
+SAMPLING_STRATEGIES = ("uniform", "favorites", "authors")
+
+
+def _button_strategies():
+    strategies = dict.fromkeys(BUTTON_FILTERS, ROULETTE_STRATEGY)
+    for item in filter(None, (part.strip() for part in ROULETTE_BUTTON_STRATEGIES.split(","))):
+        button_name, _, strategy = item.partition("=")
+        strategies[button_name.strip()] = strategy.strip()
+    for button_name, strategy in strategies.items():
+        if button_name not in BUTTON_FILTERS or strategy not in SAMPLING_STRATEGIES:
+            logger.error(f"ルーレットの抽出方法の設定が無効です: {button_name}={strategy}")
+            exit(1)
+    return strategies
+
+
+# ボタン名 -> 抽出方法
+BUTTON_STRATEGIES = _button_strategies()
+
+
+########################
+# ルーレット対象スレッド
+########################
+class RouletteThread:
+
+    __slots__ = ("thread_id", "guild_id", "panel_channel_id")
+
+    def __init__(self, thread_id, guild_id=None, panel_channel_id=None):
+        self.thread_id = thread_id
+        self.guild_id = guild_id
+        self.panel_channel_id = panel_channel_id
+
+
+# thread_id -> RouletteThread (roulette_threads テーブルと同期)
+roulette_threads = {}
+# パネルを置くチャンネル -> thread_id。スレッド内に置いたパネルは thread_id 自身で引く
+_panel_channel_threads = {}
+
+
+def thread_for_channel(channel_id):
+    """パネルのボタンやコマンドが押されたチャンネルから、対象スレッドの thread_id を返す。"""
+    if channel_id in roulette_threads:
+        return channel_id
+    thread_id = _panel_channel_threads.get(channel_id)
+    if thread_id is None and THREAD_ID in roulette_threads:
+        # 単一スレッド運用からの移行: どのチャンネルに /embed したパネルも THREAD_ID のスレッドを指す
+        return THREAD_ID
+    return thread_id
+
+
+def thread_guild_id(thread_id, fallback):
+    """スレッドのリンクに使うギルドID。設定にない(登録が外れた・未取得)ときは fallback を使う。"""
+    config = roulette_threads.get(thread_id)
+    return (config.guild_id if config is not None else None) or fallback
+
+
+def _register_thread(config):
+    previous = roulette_threads.get(config.thread_id)
+    if previous is not None and _panel_channel_threads.get(previous.panel_channel_id) == config.thread_id:
+        del _panel_channel_threads[previous.panel_channel_id]
+    roulette_threads[config.thread_id] = config
+    if config.panel_channel_id is not None:
+        _panel_channel_threads[config.panel_channel_id] = config.thread_id
+    message_catalogs.setdefault(config.thread_id, MessageCatalog())
+
+
+def _unregister_thread(thread_id):
+    config = roulette_threads.pop(thread_id, None)
+    if config is not None and _panel_channel_threads.get(config.panel_channel_id) == thread_id:
+        del _panel_channel_threads[config.panel_channel_id]
+    message_catalogs.pop(thread_id, None)
+
+
+@db_timed
+async def load_roulette_threads():
+    pool = get_db_pool()
+    if not pool:
+        return
+    try:
+        if THREAD_ID is not None:
+            await pool.execute(
+                "INSERT INTO roulette_threads (thread_id) VALUES ($1) ON CONFLICT DO NOTHING", THREAD_ID
+            )
+        rows = await pool.fetch("SELECT thread_id, guild_id, panel_channel_id FROM roulette_threads")
+    except DB_ERRORS as e:
+        logger.error(f"Error loading roulette threads: {e}")
+        return
+    for thread_id in set(roulette_threads) - {row["thread_id"] for row in rows}:
+        _unregister_thread(thread_id)
+    for row in rows:
+        _register_thread(RouletteThread(row["thread_id"], row["guild_id"], row["panel_channel_id"]))
+    logger.info(f"Loaded {len(rows)} roulette threads.")
+
+
+async def reload_roulette_threads():
+    await load_roulette_threads()
+    await load_message_catalogs()
+
+
+@db_timed
+async def save_roulette_thread(config):
+    pool = get_db_pool()
+    if not pool:
+        return False
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM messages WHERE thread_id = %s", (thread_id,))
-            rows = cur.fetchall()
-            for m in rows:
-                if m["reactions"] is None:
-                    m["reactions"] = {}
-                elif isinstance(m["reactions"], str):
-                    try:
-                        m["reactions"] = json.loads(m["reactions"]) or {}
-                    except json.JSONDecodeError:
-                        m["reactions"] = {}
-            if filter_func:
-                filtered = [row for row in rows if filter_func(row)]
-                rows = filtered
-            if not rows:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO roulette_threads (thread_id, guild_id, panel_channel_id)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (thread_id) DO UPDATE SET
+                        guild_id = EXCLUDED.guild_id,
+                        panel_channel_id = EXCLUDED.panel_channel_id
+                """, config.thread_id, config.guild_id, config.panel_channel_id)
+                await publish_changes(conn, threads=True)
+    except DB_ERRORS as e:
+        logger.error(f"Error saving roulette thread: {e}")
+        return False
+    return True
+
+
+@db_timed
+async def delete_roulette_thread(thread_id):
+    pool = get_db_pool()
+    if not pool:
+        return False
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM roulette_threads WHERE thread_id = $1", thread_id)
+                await publish_changes(conn, threads=True)
+    except DB_ERRORS as e:
+        logger.error(f"Error deleting roulette thread: {e}")
+        return False
+    return True
+
+
+########################
+# メッセージカタログ(ルーレット候補インデックス)
+########################
+class IndexedSet:
+    """O(1) で追加・削除・ランダム抽出ができる集合。"""
+
+    __slots__ = ("_items", "_pos")
+
+    def __init__(self):
+        self._items = []
+        self._pos = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._pos
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, item):
+        if item in self._pos:
+            return
+        self._pos[item] = len(self._items)
+        self._items.append(item)
+
+    def discard(self, item):
+        idx = self._pos.pop(item, None)
+        if idx is None:
+            return
+        last = self._items.pop()
+        if idx < len(self._items):
+            self._items[idx] = last
+            self._pos[last] = idx
+
+    def choice(self):
+        return random.choice(self._items)
+
+
+class WeightedIndex:
+    """
+    整数の重みを持つ要素の集合。同じ重みの要素を IndexedSet にまとめ、
+    重みの種類数ぶんの走査 + O(1) で重み付き抽出し、重みの変更も O(1) で反映する。
+    お気に入り数のように取りうる重みの種類が少ないことを前提にしている。
+    """
+
+    __slots__ = ("_weight", "_by_weight", "total")
+
+    def __init__(self):
+        self._weight = {}
+        self._by_weight = {}
+        self.total = 0
+
+    def __len__(self):
+        return len(self._weight)
+
+    def weight(self, item):
+        return self._weight.get(item, 0)
+
+    def set(self, item, weight):
+        self.discard(item)
+        self._weight[item] = weight
+        self._by_weight.setdefault(weight, IndexedSet()).add(item)
+        self.total += weight
+
+    def discard(self, item):
+        weight = self._weight.pop(item, None)
+        if weight is None:
+            return
+        items = self._by_weight[weight]
+        items.discard(item)
+        if not items:
+            del self._by_weight[weight]
+        self.total -= weight
+
+    def choice(self):
+        r = random.random() * self.total
+        for weight, items in self._by_weight.items():
+            r -= weight * len(items)
+            if r < 0:
+                return items.choice()
+        return items.choice()
+
+
+class MessageCatalog:
+    """
+    1スレッド分のメッセージを author / (emoji, user) でインデックスしたメモリ上のカタログ。
+    起動時に一度だけDBから構築し、以降はメッセージ・リアクションのイベントと同期処理から差分更新する。
+    削除されたメッセージは (emoji, user) の索引からは抽出時に遅延して取り除く。
+    スナップショットから復元した場合や他プロセスの通知を取りこぼした場合は stale になり、
+    抽出に使い続けながら裏でDBから作り直す。作り直しの間の更新は両方に反映する。
+    """
+
+    # 除外条件に当たり続けた場合に線形走査へ切り替えるまでの試行回数
+    MAX_SAMPLE_ATTEMPTS = 16
+    # 再追加を防ぐために覚えておく削除済み message_id の上限。古いものから忘れる
+    MAX_DELETED_IDS = 10000
+
+    def __init__(self):
+        self.loaded = False
+        self.stale = False
+        self.reloading = False
+        self._pending = []
+        # 削除済みの message_id (挿入順)。古い履歴ページなどから再追加されないようにする
+        self._deleted = {}
+        self._clear()
+
+    def _clear(self):
+        self._all = IndexedSet()
+        self._author = {}
+        self._by_author = {}
+        self._by_reaction = {}
+        # 投稿が1件以上ある作者(作者層別抽出用)と、1 + お気に入り数を重みにした投稿(重み付き抽出用)
+        self._authors = IndexedSet()
+        self._favorite_weights = WeightedIndex()
+
+    def __len__(self):
+        return len(self._all)
+
+    def __contains__(self, message_id):
+        return message_id in self._author
+
+    def load(self, messages, reactions):
+        """
+        (message_id, author_id) と (message_id, emoji_id, user_id) の列からカタログを構築し、
+        構築中に溜めた更新を反映する。読み込み済みのカタログに呼ぶと中身を置き換える。
+        """
+        if self.loaded:
+            self._clear()
+        # DBの行は削除済みを除いてあるので、それまでの削除の記録は要らない(構築中の削除は下の pending で記録し直す)
+        self._deleted = {}
+        for message_id, author_id in messages:
+            self._add_message(message_id, author_id)
+        for message_id, emoji_id, user_id in reactions:
+            self._apply_reaction(message_id, emoji_id, user_id, True)
+        self.loaded = True
+        self.stale = False
+        self.reloading = False
+        pending, self._pending = self._pending, []
+        for op, args in pending:
+            op(*args)
+        logger.info(f"Message catalog loaded: {len(self._all)} messages.")
+
+    def begin_reload(self):
+        """DBからの読み直しを始める。load() か abort_reload() までの更新は溜めておく。"""
+        self.reloading = True
+
+    def abort_reload(self):
+        self.reloading = False
+        if self.loaded:
+            self._pending = []
+
+    def export(self):
+        """(message_id, author_id) と (message_id, emoji_id, user_id) を平らに並べた int64 配列を返す。"""
+        messages = array("q", chain.from_iterable(self._author.items()))
+        reactions = array("q", chain.from_iterable(
+            (message_id, emoji_id, user_id)
+            for (emoji_id, user_id), ids in self._by_reaction.items()
+            for message_id in ids
+            if message_id in self._author
+        ))
+        return messages, reactions
+
+    def _update(self, op, *args):
+        if not self.loaded or self.reloading:
+            self._pending.append((op, args))
+        if self.loaded:
+            op(*args)
+
+    def add_message(self, message_id, author_id):
+        self._update(self._add_message, message_id, author_id)
+
+    def apply_reaction(self, message_id, emoji_id, user_id, add=True):
+        self._update(self._apply_reaction, message_id, emoji_id, user_id, add)
+
+    def remove_message(self, message_id):
+        self._update(self._remove_message, message_id)
+
+    def _add_message(self, message_id, author_id):
+        if message_id in self._author or message_id in self._deleted:
+            return
+        self._author[message_id] = author_id
+        self._all.add(message_id)
+        self._by_author.setdefault(author_id, IndexedSet()).add(message_id)
+        self._authors.add(author_id)
+        self._favorite_weights.set(message_id, 1)
+
+    def _remove_message(self, message_id):
+        self._deleted[message_id] = None
+        if len(self._deleted) > self.MAX_DELETED_IDS:
+            del self._deleted[next(iter(self._deleted))]
+        author_id = self._author.pop(message_id, None)
+        if author_id is None:
+            return
+        self._all.discard(message_id)
+        self._favorite_weights.discard(message_id)
+        ids = self._by_author.get(author_id)
+        if ids is not None:
+            ids.discard(message_id)
+            if not ids:
+                del self._by_author[author_id]
+                self._authors.discard(author_id)
+
+    def _apply_reaction(self, message_id, emoji_id, user_id, add):
+        if message_id not in self._author:
+            return
+        key = (emoji_id, user_id)
+        ids = self._by_reaction.get(key)
+        if add:
+            if ids is None:
+                ids = self._by_reaction[key] = IndexedSet()
+            elif message_id in ids:
+                return
+            ids.add(message_id)
+        else:
+            if ids is None or message_id not in ids:
+                return
+            ids.discard(message_id)
+            if not ids:
+                del self._by_reaction[key]
+        if emoji_id == FAVORITE_REACTION_ID:
+            weight = self._favorite_weights.weight(message_id) + (1 if add else -1)
+            self._favorite_weights.set(message_id, weight)
+
+    def user_reacted(self, message_id, emoji_id, user_id):
+        ids = self._by_reaction.get((emoji_id, user_id))
+        return ids is not None and message_id in ids
+
+    def pick(self, spec):
+        """
+        RouletteFilter に合うメッセージを1件ランダムに選ぶ。
+        候補集合(全体 or require_reaction を付けた投稿)から spec.strategy に従って棄却サンプリングし、
+        除外に当たり続けた場合のみ候補集合を線形走査する。
+        自分のリアクションで絞った候補集合は小さいので、uniform 以外は最初から線形走査で重み付けする。
+        """
+        if spec.require_reaction is not None:
+            pool = self._by_reaction.get((spec.require_reaction, spec.user_id))
+        else:
+            pool = self._all
+        if not pool:
+            return None
+        forbidden = None
+        if spec.forbid_reaction is not None:
+            forbidden = self._by_reaction.get((spec.forbid_reaction, spec.user_id))
+        exclude_authors = spec.exclude_authors
+        exclude_messages = spec.exclude_messages
+
+        def eligible(message_id):
+            author_id = self._author.get(message_id)
+            if author_id is None or author_id in exclude_authors:
+                return False
+            if message_id in exclude_messages:
+                return False
+            if forbidden is not None and message_id in forbidden:
+                return False
+            return True
+
+        if spec.strategy == "uniform":
+            sample = pool.choice
+        elif spec.require_reaction is not None:
+            sample = None
+        elif spec.strategy == "favorites":
+            sample = self._favorite_weights.choice
+        else:
+            sample = self._sample_by_author
+
+        for _ in range(self.MAX_SAMPLE_ATTEMPTS if sample else 0):
+            if not pool:
                 return None
-            return random.choice(rows)
-    except Error as e:
-        logger.error(f"Error fetching random message: {e}")
+            message_id = sample()
+            if message_id not in self._author:
+                # 削除済み。リアクションの索引から取り除く
+                pool.discard(message_id)
+                continue
+            if eligible(message_id):
+                return {"message_id": message_id, "author_id": self._author[message_id]}
+
+        candidates = [m for m in pool if eligible(m)]
+        if not candidates:
+            return None
+        message_id = self._choose(candidates, spec.strategy)
+        return {"message_id": message_id, "author_id": self._author[message_id]}
+
+    def _sample_by_author(self):
+        return self._by_author[self._authors.choice()].choice()
+
+    def _choose(self, candidates, strategy):
+        if strategy == "favorites":
+            weights = [self._favorite_weights.weight(m) for m in candidates]
+            return random.choices(candidates, weights=weights)[0]
+        if strategy == "authors":
+            by_author = {}
+            for message_id in candidates:
+                by_author.setdefault(self._author[message_id], []).append(message_id)
+            return random.choice(random.choice(list(by_author.values())))
+        return random.choice(candidates)
+
+
+# thread_id -> MessageCatalog。スレッドごとに独立しているので、他スレッドの件数は抽出に影響しない
+message_catalogs = {}
+
+if THREAD_ID is not None:
+    _register_thread(RouletteThread(THREAD_ID))
+
+
+async def load_message_catalogs():
+    for thread_id in list(roulette_threads):
+        await load_message_catalog(thread_id)
+
+
+async def reload_message_catalogs():
+    """他プロセスの変更を取りこぼした可能性があるときに、全カタログをDBから作り直す。"""
+    for thread_id in list(roulette_threads):
+        message_catalogs.setdefault(thread_id, MessageCatalog()).stale = True
+    await load_message_catalogs()
+
+
+@db_timed
+async def load_message_catalog(thread_id):
+    message_catalog = message_catalogs.get(thread_id)
+    if message_catalog is None or message_catalog.reloading:
+        return
+    if message_catalog.loaded and not message_catalog.stale:
+        return
+    pool = get_db_pool()
+    if not pool:
+        return
+    message_catalog.begin_reload()
+    # 古いカタログには反映済みでDBにはまだ無い操作が、読み直しで消えないよう先に書き切る
+    await reaction_queue.flush()
+    try:
+        async with pool.acquire() as conn:
+            messages = await conn.fetch(
+                "SELECT message_id, author_id FROM messages WHERE thread_id = $1 AND deleted_at IS NULL",
+                thread_id, timeout=DB_BULK_TIMEOUT
+            )
+            reactions = await conn.fetch("""
+                SELECT r.message_id, r.emoji_id, r.user_id
+                FROM message_reactions r
+                JOIN messages m ON m.message_id = r.message_id
+                WHERE m.thread_id = $1 AND m.deleted_at IS NULL
+            """, thread_id, timeout=DB_BULK_TIMEOUT)
+    except DB_ERRORS as e:
+        logger.error(f"Error loading message catalog: {e}")
+        message_catalog.abort_reload()
+        return
+    message_catalog.load(messages, reactions)
+    # 書き切れなかった分(DBが落ちている間に溜まったものなど)は当て直す
+    reaction_queue.replay(message_catalog, thread_id)
+
+
+@db_timed
+async def get_random_message(thread_id, spec, button_name="N/A"):
+    pool = get_db_pool()
+    if not pool:
         return None
+    try:
+        query, params = spec.to_sample_query(thread_id)
+        row = await pool.fetchrow(query, *params)
+        return dict(row) if row else None
+    except DB_ERRORS as e:
+        logger.error(f"Error fetching random message ({button_name}): {e}")
+        return None
+
+
+########################
+# スナップショット
+########################
+# ファイルはネイティブのバイト順の int64 の列で、mmap したまま読める。
+#   ヘッダ: MAGIC, VERSION, スレッド数
+#   スレッドごとに: thread_id, guild_id, panel_channel_id, メッセージ数(未読み込みなら -1), リアクション数
+#   続けてスレッド順に: (message_id, author_id) * メッセージ数, (message_id, emoji_id, user_id) * リアクション数
+# 未書き込みの操作は本文を含むので、別ファイルに JSON で置く
+SNAPSHOT_MAGIC = int.from_bytes(b"MCATSNAP", "little")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PENDING_PATH = f"{SNAPSHOT_PATH}.pending.json"
+
+
+def restore_snapshot():
+    """
+    スナップショットからスレッドの登録とカタログ、未書き込みの操作を復元する。
+    復元したカタログは stale として、DBに繋がった時点で読み直す。
+    """
+    if not SNAPSHOT_PATH:
+        return
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            restored = _read_snapshot(mm)
+        logger.info(f"Restored {restored} roulette threads from snapshot {SNAPSHOT_PATH}.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading snapshot {SNAPSHOT_PATH}: {e}")
+    try:
+        with open(SNAPSHOT_PENDING_PATH, encoding="utf-8") as f:
+            pending = json.load(f)
+        os.remove(SNAPSHOT_PENDING_PATH)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading pending writes {SNAPSHOT_PENDING_PATH}: {e}")
+        return
+    reaction_queue.restore(pending)
+    logger.info(f"Restored {len(reaction_queue)} pending writes from snapshot.")
+
+
+def _read_snapshot(mm):
+    if len(mm) % 8:
+        raise ValueError(f"snapshot size {len(mm)} is not a multiple of 8")
+    view = memoryview(mm).cast("q")
+    try:
+        if len(view) < 3 or view[0] != SNAPSHOT_MAGIC or view[1] != SNAPSHOT_VERSION:
+            raise ValueError("unknown snapshot format")
+        n_threads = view[2]
+        records = [view[3 + 5 * i:8 + 5 * i].tolist() for i in range(n_threads)]
+        offset = 3 + 5 * n_threads
+        expected = offset + sum(2 * max(n_messages, 0) + 3 * n_reactions for *_, n_messages, n_reactions in records)
+        if len(view) != expected:
+            raise ValueError(f"snapshot has {len(view)} words, expected {expected}")
+        for thread_id, guild_id, panel_channel_id, n_messages, n_reactions in records:
+            _register_thread(RouletteThread(thread_id, guild_id or None, panel_channel_id or None))
+            if n_messages < 0:
+                continue
+            messages = view[offset:offset + 2 * n_messages]
+            offset += 2 * n_messages
+            reactions = view[offset:offset + 3 * n_reactions]
+            offset += 3 * n_reactions
+            message_catalog = message_catalogs[thread_id]
+            if not message_catalog.loaded:
+                message_catalog.load(
+                    zip(messages[0::2], messages[1::2]),
+                    zip(reactions[0::3], reactions[1::3], reactions[2::3])
+                )
+                message_catalog.stale = True
+        return n_threads
     finally:
-        release_db_connection(conn)
+        view.release()
+
+
+async def save_snapshot():
+    if not SNAPSHOT_PATH:
+        return
+    # 書き出す配列はイベントループ上で一度に作り、ファイルへの書き込みだけスレッドに出す
+    records = array("q", [SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(roulette_threads)])
+    parts = [records]
+    for thread_id, config in roulette_threads.items():
+        message_catalog = message_catalogs.get(thread_id)
+        if message_catalog is not None and message_catalog.loaded:
+            messages, reactions = message_catalog.export()
+            n_messages = len(messages) // 2
+        else:
+            messages = reactions = array("q")
+            n_messages = -1
+        records.extend([thread_id, config.guild_id or 0, config.panel_channel_id or 0, n_messages, len(reactions) // 3])
+        parts += [messages, reactions]
+    pending = reaction_queue.dump() if len(reaction_queue) else None
+    try:
+        await asyncio.to_thread(_write_snapshot, parts, pending)
+    except OSError as e:
+        logger.error(f"Error writing snapshot {SNAPSHOT_PATH}: {e}")
+        return
+    size = sum(len(part) for part in parts) * 8
+    hot_log.info(
+        "snapshot_saved",
+        f"Saved snapshot of {len(roulette_threads)} threads ({size} bytes, {len(reaction_queue)} pending writes).",
+        threads=len(roulette_threads), bytes=size, pending=len(reaction_queue)
+    )
+
+
+def _write_snapshot(parts, pending):
+    # 書き込み途中で落ちても前回のファイルが残るよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, "wb") as f:
+        for part in parts:
+            part.tofile(f)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+    if pending is None:
+        try:
+            os.remove(SNAPSHOT_PENDING_PATH)
+        except FileNotFoundError:
+            pass
+        return
+    with open(f"{SNAPSHOT_PENDING_PATH}.tmp", "w", encoding="utf-8") as f:
+        json.dump(pending, f)
+    os.replace(f"{SNAPSHOT_PENDING_PATH}.tmp", SNAPSHOT_PENDING_PATH)
+
+
+@tasks.loop(minutes=SNAPSHOT_INTERVAL_MINUTES)
+async def snapshot_task():
+    await save_snapshot()
+
+
+########################
+# おすすめ履歴
+########################
+class RecentRing:
+    """直近 capacity 件の (message_id, author_id, 表示時刻) を配列で持つリングバッファ。"""
+
+    __slots__ = ("message_ids", "author_ids", "shown_at", "head", "size")
+
+    def __init__(self, capacity):
+        self.message_ids = array("q", bytes(8 * capacity))
+        self.author_ids = array("q", bytes(8 * capacity))
+        self.shown_at = array("d", bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+
+    def push(self, message_id, author_id, shown_at):
+        self.message_ids[self.head] = message_id
+        self.author_ids[self.head] = author_id
+        self.shown_at[self.head] = shown_at
+        self.head = (self.head + 1) % len(self.message_ids)
+        self.size = min(self.size + 1, len(self.message_ids))
+
+    def entries(self):
+        """古い順に (message_id, author_id, shown_at) を返す。"""
+        capacity = len(self.message_ids)
+        for i in range(self.head - self.size, self.head):
+            i %= capacity
+            yield self.message_ids[i], self.author_ids[i], self.shown_at[i]
+
+    def latest(self):
+        if not self.size:
+            return None
+        i = (self.head - 1) % len(self.message_ids)
+        return self.message_ids[i], self.author_ids[i], self.shown_at[i]
+
+
+class RecommendationHistory:
+    """
+    ユーザーごとに直近おすすめした投稿を RecentRing で保持する。
+    TTL を過ぎた履歴は除外に使わず、最後のおすすめから TTL を過ぎたユーザーはメモリから追い出す。
+    変更は一定間隔で recommendation_history テーブルへ書き戻す。
+    """
+
+    def __init__(self, capacity, ttl_seconds):
+        self.capacity = capacity
+        self.ttl = ttl_seconds
+        self._rings = {}
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._rings)
+
+    def record(self, user_id, message_id, author_id):
+        if not self.capacity:
+            # RECOMMEND_HISTORY_SIZE=0 は履歴による除外を使わない設定
+            return
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._rings[user_id] = RecentRing(self.capacity)
+        ring.push(message_id, author_id, time.time())
+        self._dirty.add(user_id)
+
+    def recent(self, user_id):
+        """(有効期限内に表示した message_id の集合, 前回の作者 or None) を返す。"""
+        ring = self._rings.get(user_id)
+        if ring is None:
+            return frozenset(), None
+        cutoff = time.time() - self.ttl
+        message_ids = frozenset(m for m, _, shown_at in ring.entries() if shown_at >= cutoff)
+        latest = ring.latest()
+        last_author = latest[1] if latest and latest[2] >= cutoff else None
+        return message_ids, last_author
+
+    def evict_idle(self):
+        cutoff = time.time() - self.ttl
+        idle = [u for u, ring in self._rings.items() if u not in self._dirty and ring.latest()[2] < cutoff]
+        for user_id in idle:
+            del self._rings[user_id]
+        return len(idle)
+
+    @db_timed
+    async def load(self):
+        pool = get_db_pool()
+        if not pool or not self.capacity:
+            return
+        try:
+            rows = await pool.fetch("""
+                SELECT user_id, message_ids, author_ids, shown_at FROM recommendation_history
+                WHERE updated_at > now() - make_interval(secs => $1)
+            """, self.ttl)
+        except DB_ERRORS as e:
+            logger.error(f"Error loading recommendation history: {e}")
+            return
+        for row in rows:
+            message_ids = array("q", row["message_ids"])
+            author_ids = array("q", row["author_ids"])
+            shown_at = array("d", row["shown_at"])
+            # 保存時と capacity が変わっていても、古い順に積み直せば新しい方が残る
+            ring = RecentRing(self.capacity)
+            for entry in zip(message_ids, author_ids, shown_at):
+                ring.push(*entry)
+            # DBに繋がる前に記録した分の方が新しい
+            self._rings.setdefault(row["user_id"], ring)
+        logger.info(f"Loaded recommendation history for {len(rows)} users.")
+
+    @db_timed
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for user_id in dirty:
+            ring = self._rings.get(user_id)
+            if ring is None:
+                continue
+            message_ids, author_ids, shown_at = array("q"), array("q"), array("d")
+            for message_id, author_id, at in ring.entries():
+                message_ids.append(message_id)
+                author_ids.append(author_id)
+                shown_at.append(at)
+            rows.append((user_id, message_ids.tobytes(), author_ids.tobytes(), shown_at.tobytes()))
+        if not rows:
+            return
+        pool = get_db_pool()
+        if not pool:
+            self._dirty |= dirty
+            return
+        try:
+            await pool.execute("""
+                INSERT INTO recommendation_history (user_id, message_ids, author_ids, shown_at)
+                SELECT * FROM unnest($1::BIGINT[], $2::BYTEA[], $3::BYTEA[], $4::BYTEA[])
+                ON CONFLICT (user_id) DO UPDATE SET
+                    message_ids = EXCLUDED.message_ids,
+                    author_ids = EXCLUDED.author_ids,
+                    shown_at = EXCLUDED.shown_at,
+                    updated_at = now()
+            """, *zip(*rows))
+        except DB_ERRORS as e:
+            logger.error(f"Error saving recommendation history: {e}")
+            self._dirty |= dirty
+
+
+recommendation_history = RecommendationHistory(RECOMMEND_HISTORY_SIZE, RECOMMEND_HISTORY_TTL_HOURS * 3600)
+
+
+@tasks.loop(seconds=RECOMMEND_HISTORY_FLUSH_INTERVAL)
+async def recommendation_history_task():
+    await recommendation_history.flush()
+    evicted = recommendation_history.evict_idle()
+    if evicted:
+        logger.info(f"Evicted {evicted} idle users from recommendation history.")
+
+
+########################
+# 作者名キャッシュ
+########################
+class AuthorNameCache:
+    """
+    author_id -> 表示名 の LRU + TTL キャッシュ。
+    期限切れの名前はそのまま返しつつ、未登録・期限切れの解決はバックグラウンドでまとめて行う。
+    解決した名前は author_names テーブルに保存し、再起動後も引き継ぐ。
+    """
+
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._names = OrderedDict()
+        self._to_resolve = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, author_id):
+        """キャッシュ上の名前を返す。期限切れなら再解決を予約する。未登録なら None。"""
+        entry = self._names.get(author_id)
+        if entry is None:
+            return None
+        self._names.move_to_end(author_id)
+        name, expires_at = entry
+        if expires_at <= time.monotonic():
+            self.resolve_later(author_id)
+        return name
+
+    def put(self, author_id, name, age_seconds=0):
+        self._names[author_id] = (name, time.monotonic() + self.ttl - age_seconds)
+        self._names.move_to_end(author_id)
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def resolve_later(self, author_id):
+        self._to_resolve.add(author_id)
+        self._wakeup.set()
+
+    def is_running(self):
+        return self._task is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            author_ids, self._to_resolve = self._to_resolve, set()
+            try:
+                resolved = await resolve_author_names(author_ids)
+                for author_id, name in resolved.items():
+                    self.put(author_id, name)
+                await save_author_names(resolved)
+            except Exception as e:
+                logger.error(f"Error resolving author names: {e}", exc_info=True)
+
+    async def warm(self):
+        """DBに保存済みの名前と、全ギルドのメンバー一覧(チャンク)からまとめて読み込む。"""
+        pool = get_db_pool()
+        if pool:
+            try:
+                rows = await pool.fetch("""
+                    SELECT author_id, display_name, EXTRACT(EPOCH FROM now() - updated_at) AS age
+                    FROM author_names
+                    ORDER BY updated_at DESC
+                    LIMIT $1
+                """, self.max_size)
+            except DB_ERRORS as e:
+                logger.error(f"Error loading author names: {e}")
+                rows = []
+            for row in reversed(rows):
+                self.put(row["author_id"], row["display_name"], float(row["age"]))
+
+        fresh = {}
+        for guild in bot.guilds:
+            try:
+                members = guild.members if guild.chunked else await guild.chunk()
+            except discord.HTTPException as e:
+                logger.error(f"Error chunking members of guild {guild.id}: {e}")
+                continue
+            for member in members:
+                fresh[member.id] = member.display_name
+        for author_id, name in fresh.items():
+            self.put(author_id, name)
+        await save_author_names(fresh)
+        logger.info(f"Author name cache warmed: {len(self._names)} names.")
+
+
+def _cached_display_name(author_id):
+    """REST を使わず、ゲートウェイのキャッシュだけで表示名を引く。"""
+    for guild in bot.guilds:
+        member = guild.get_member(author_id)
+        if member:
+            return member.display_name
+    user = bot.get_user(author_id)
+    if user:
+        return user.display_name or user.name
+    return None
+
+
+def author_display_name(author_id):
+    """
+    キャッシュだけで作者の表示名を返す。REST は呼ばない。
+    未解決の作者は裏で解決し、次回から名前を出す。
+    """
+    name = author_names.get(author_id)
+    if name is None:
+        name = _cached_display_name(author_id)
+        if name is not None:
+            author_names.put(author_id, name)
+        else:
+            author_names.resolve_later(author_id)
+            name = f"UnknownUser({author_id})"
+    return name
+
+
+async def resolve_author_names(author_ids):
+    resolved = {}
+    for author_id in author_ids:
+        name = _cached_display_name(author_id)
+        if name is None:
+            try:
+                async with rest_scheduler.slot("background", "GET /users/:id"):
+                    user = await bot.fetch_user(author_id)
+                name = user.display_name or user.name
+            except discord.NotFound:
+                continue
+            except discord.HTTPException as e:
+                logger.error(f"Error fetching user {author_id}: {e}")
+                continue
+        resolved[author_id] = name
+    return resolved
+
+
+@db_timed
+async def save_author_names(names):
+    if not names:
+        return
+    pool = get_db_pool()
+    if not pool:
+        return
+    try:
+        await pool.execute("""
+            INSERT INTO author_names (author_id, display_name)
+            SELECT * FROM unnest($1::BIGINT[], $2::TEXT[])
+            ON CONFLICT (author_id) DO UPDATE SET
+                display_name = EXCLUDED.display_name,
+                updated_at = now()
+        """, list(names), list(names.values()), timeout=DB_BULK_TIMEOUT)
+    except DB_ERRORS as e:
+        logger.error(f"Error saving author names: {e}")
+
+
+author_names = AuthorNameCache(AUTHOR_NAME_CACHE_SIZE, AUTHOR_NAME_TTL_HOURS * 3600)
 
 
 ########################
@@ -323,120 +2683,127 @@ class CombinedView(discord.ui.View):
         super().__init__(timeout=None)
 
     async def get_author_name(self, author_id):
-        user = bot.get_user(author_id)
-        if user is None:
-            try:
-                user = await bot.fetch_user(author_id)
-            except discord.NotFound:
-                user = None
-        if user:
-            return user.display_name or user.name
-        else:
-            return f"UnknownUser({author_id})"
+        # クリック時は REST を呼ばない
+        return author_display_name(author_id)
 
-    async def handle_selection(self, interaction, random_message, user_id):
+    async def handle_selection(self, interaction, random_message, user_id, thread_id):
         if random_message:
-            last_chosen_authors[user_id] = random_message["author_id"]
+            recommendation_history.record(user_id, random_message["message_id"], random_message["author_id"])
             author_name = await self.get_author_name(random_message["author_id"])
-            await interaction.channel.send(
+            guild_id = thread_guild_id(thread_id, interaction.guild_id)
+            content = (
                 f"{interaction.user.mention} さんには、{author_name} さんの投稿がおすすめだよ！\n"
-                f"https://discord.com/channels/{interaction.guild_id}/{THREAD_ID}/{random_message['message_id']}"
+                f"https://discord.com/channels/{guild_id}/{thread_id}/{random_message['message_id']}"
             )
         else:
-            await interaction.channel.send(
-                f"{interaction.user.mention} さん、該当する投稿がありませんでした。"
-            )
+            content = f"{interaction.user.mention} さん、該当する投稿がありませんでした。"
+        async with rest_scheduler.slot("interactive", "POST /channels/:id/messages"):
+            await interaction.channel.send(content)
         await send_panel(interaction.channel)
 
-    async def get_and_handle_random_message(self, interaction, filter_func, button_name="N/A"):
-        await interaction.response.defer()
-        random_msg = await get_random_message(THREAD_ID, filter_func=filter_func, button_name=button_name)
-        await self.handle_selection(interaction, random_msg, interaction.user.id)
+    async def get_and_handle_random_message(self, interaction, button_name):
+        with CLICK_SECONDS.time(button_name):
+            thread_id = thread_for_channel(interaction.channel_id)
+            if thread_id is None:
+                await interaction.response.send_message("このチャンネルはルーレットの対象に登録されていません。", ephemeral=True)
+                return
+            await interaction.response.defer()
+            user_id = interaction.user.id
+            recent_message_ids, last_author_id = recommendation_history.recent(user_id)
+            spec = RouletteFilter.for_button(button_name, user_id, last_author_id, recent_message_ids)
+            random_msg = await self.pick(thread_id, spec, button_name)
+            if random_msg is None and spec.exclude_messages:
+                random_msg = await self.pick(thread_id, spec.without_recent(), button_name)
+            await self.handle_selection(interaction, random_msg, user_id, thread_id)
+
+    async def pick(self, thread_id, spec, button_name):
+        message_catalog = message_catalogs.get(thread_id)
+        if message_catalog is not None and message_catalog.loaded:
+            return message_catalog.pick(spec)
+        return await get_random_message(thread_id, spec, button_name=button_name)
 
     @discord.ui.button(label="ランダム", style=discord.ButtonStyle.primary, row=0, custom_id="blue_random_unique_id")
     async def blue_random(self, interaction: discord.Interaction, button: discord.ui.Button):
-        button_name = "blue_random"
-
-        def filter_func(msg):
-            if msg["author_id"] == interaction.user.id:
-                return False
-            if last_chosen_authors.get(interaction.user.id) == msg["author_id"]:
-                return False
-            if msg["author_id"] == SPECIFIC_EXCLUDE_USER:
-                return False
-            return True
-
-        await self.get_and_handle_random_message(interaction, filter_func, button_name=button_name)
+        await self.get_and_handle_random_message(interaction, button_name="blue_random")
 
     @discord.ui.button(label="あとで読む", style=discord.ButtonStyle.primary, row=0, custom_id="read_later_unique_id")
     async def read_later(self, interaction: discord.Interaction, button: discord.ui.Button):
-        button_name = "blue_read_later"
-
-        def filter_func(msg):
-            if not user_reacted(msg, READ_LATER_REACTION_ID, interaction.user.id):
-                return False
-            if msg["author_id"] == interaction.user.id:
-                return False
-            if last_chosen_authors.get(interaction.user.id) == msg["author_id"]:
-                return False
-            if msg["author_id"] == SPECIFIC_EXCLUDE_USER:
-                return False
-            return True
-
-        await self.get_and_handle_random_message(interaction, filter_func, button_name=button_name)
+        await self.get_and_handle_random_message(interaction, button_name="blue_read_later")
 
     @discord.ui.button(label="お気に入り", style=discord.ButtonStyle.primary, row=0, custom_id="favorite_unique_id")
     async def favorite(self, interaction: discord.Interaction, button: discord.ui.Button):
-        button_name = "blue_favorite"
-
-        def filter_func(msg):
-            if not user_reacted(msg, FAVORITE_REACTION_ID, interaction.user.id):
-                return False
-            if msg["author_id"] == interaction.user.id:
-                return False
-            if last_chosen_authors.get(interaction.user.id) == msg["author_id"]:
-                return False
-            if msg["author_id"] == SPECIFIC_EXCLUDE_USER:
-                return False
-            return True
-
-        await self.get_and_handle_random_message(interaction, filter_func, button_name=button_name)
+        await self.get_and_handle_random_message(interaction, button_name="blue_favorite")
 
     @discord.ui.button(label="ランダム", style=discord.ButtonStyle.danger, row=1, custom_id="red_random_unique_id")
     async def red_random(self, interaction: discord.Interaction, button: discord.ui.Button):
-        button_name = "red_random"
-
-        def filter_func(msg):
-            if user_reacted(msg, RANDOM_EXCLUDE_ID, interaction.user.id):
-                return False
-            if msg["author_id"] == interaction.user.id:
-                return False
-            if msg["author_id"] == SPECIFIC_EXCLUDE_USER:
-                return False
-            if last_chosen_authors.get(interaction.user.id) == msg["author_id"]:
-                return False
-            return True
-
-        await self.get_and_handle_random_message(interaction, filter_func, button_name=button_name)
+        await self.get_and_handle_random_message(interaction, button_name="red_random")
 
     @discord.ui.button(label="あとで読む", style=discord.ButtonStyle.danger, row=1, custom_id="conditional_read_later_unique_id")
     async def conditional_read_later(self, interaction: discord.Interaction, button: discord.ui.Button):
-        button_name = "red_read_later"
+        await self.get_and_handle_random_message(interaction, button_name="red_read_later")
 
-        def filter_func(msg):
-            if not user_reacted(msg, READ_LATER_REACTION_ID, interaction.user.id):
-                return False
-            if user_reacted(msg, RANDOM_EXCLUDE_ID, interaction.user.id):
-                return False
-            if msg["author_id"] == interaction.user.id:
-                return False
-            if last_chosen_authors.get(interaction.user.id) == msg["author_id"]:
-                return False
-            if msg["author_id"] == SPECIFIC_EXCLUDE_USER:
-                return False
-            return True
 
-        await self.get_and_handle_random_message(interaction, filter_func, button_name=button_name)
+class SearchView(discord.ui.View):
+    """/search の結果のページ送りと、検索結果の中からのルーレット。"""
+
+    def __init__(self, thread_id, query, guild_id):
+        super().__init__(timeout=SEARCH_VIEW_TIMEOUT)
+        self.thread_id = thread_id
+        self.query = query
+        self.guild_id = guild_id
+        self.page = 0
+
+    async def render(self):
+        """現在のページの embed を返す。DBが使えなければ None。"""
+        # 1件多く取って次のページがあるかを判定する
+        rows = await search_messages(
+            self.thread_id, self.query, SEARCH_PAGE_SIZE + 1, self.page * SEARCH_PAGE_SIZE
+        )
+        if rows is None:
+            return None
+        has_next = len(rows) > SEARCH_PAGE_SIZE
+        lines = []
+        for rank, row in enumerate(rows[:SEARCH_PAGE_SIZE], self.page * SEARCH_PAGE_SIZE + 1):
+            title = (row["content"] or "").strip().split("\n", 1)[0][:60] or "(本文なし)"
+            lines.append(
+                f"{rank}. {title} / {author_display_name(row['author_id'])} さん\n"
+                f"https://discord.com/channels/{self.guild_id}/{self.thread_id}/{row['message_id']}"
+            )
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = not has_next
+        self.search_roulette.disabled = not lines and self.page == 0
+        return discord.Embed(
+            title=f"「{self.query}」の検索結果",
+            description="\n".join(lines) or "該当する投稿がありませんでした。",
+            color=0xFF69B4
+        ).set_footer(text=f"{self.page + 1} ページ目")
+
+    async def show_page(self, interaction, page):
+        self.page = page
+        embed = await self.render()
+        if embed is None:
+            await interaction.response.send_message("検索中にエラーが発生しました。", ephemeral=True)
+            return
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="前へ", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label="次へ", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+    @discord.ui.button(label="この中からルーレット", style=discord.ButtonStyle.primary)
+    async def search_roulette(self, interaction: discord.Interaction, button: discord.ui.Button):
+        with CLICK_SECONDS.time("search_roulette"):
+            await interaction.response.defer()
+            user_id = interaction.user.id
+            recent_message_ids, _ = recommendation_history.recent(user_id)
+            random_msg = await pick_search_match(self.thread_id, self.query, recent_message_ids)
+            if random_msg is None and recent_message_ids:
+                random_msg = await pick_search_match(self.thread_id, self.query)
+            await CombinedView().handle_selection(interaction, random_msg, user_id, self.thread_id)
 
 
 ########################
@@ -445,47 +2812,144 @@ class CombinedView(discord.ui.View):
 @bot.event
 async def on_ready():
     logger.info(f"Bot is online! {bot.user}")
-    save_all_messages_to_db_task.start()
-    try:
-        synced = await bot.tree.sync()
-        logger.info(f"Synced {len(synced)} slash commands.")
-    except Exception as e:
-        logger.error(f"Error syncing slash commands: {e}")
+    if not snapshot_task.is_running():
+        snapshot_task.start()
+    # コマンドの登録はグローバルなので、シャード0を受け持つプロセスだけが行う
+    if bot.shard_ids is None or 0 in bot.shard_ids:
+        try:
+            synced = await bot.tree.sync()
+            logger.info(f"Synced {len(synced)} slash commands.")
+        except Exception as e:
+            logger.error(f"Error syncing slash commands: {e}")
     bot.add_view(CombinedView())
     logger.info("Registered CombinedView as a persistent view.")
 
+    # 以下はDBを使うので、connect_db() が終わってから始める。
+    # 先に始めると最初の同期が1周期まるごと飛ばされ、作者名のDBからの読み込みも空振りする
+    await bot.db_task
+    if not author_names.is_running():
+        author_names.start()
+        asyncio.create_task(author_names.warm())
+    if not save_all_messages_to_db_task.is_running():
+        save_all_messages_to_db_task.start()
+    if not recommendation_history_task.is_running():
+        recommendation_history_task.start()
+
 
 ########################
 # パネルの送信
 ########################
-current_panel_message_id = None
+PANEL_TITLE = "🎯 エロ漫画ルーレット"
+
+# channel_id -> 現在のパネルの message_id (panel_messages テーブルと同期)
+panel_messages = {}
+# 起動後に履歴から古いパネルを探し済みのチャンネル
+_panel_scanned_channels = set()
+_panel_last_posted = {}
+_panel_pending = {}
+
+
+async def send_panel(channel, force=False):
+    """
+    パネルをチャンネルの最下部に出し直す。
+    直前の再投稿から PANEL_DEBOUNCE_SECONDS 以内の呼び出しは、窓の終わりの1回にまとめる。
+    """
+    if force:
+        await _repost_panel(channel)
+        return
+    if channel.id in _panel_pending:
+        return
+    wait = _panel_last_posted.get(channel.id, 0) + PANEL_DEBOUNCE_SECONDS - time.monotonic()
+    if wait <= 0:
+        await _repost_panel(channel)
+    else:
+        _panel_pending[channel.id] = asyncio.create_task(_repost_panel_later(channel, wait))
+
+
+async def _repost_panel_later(channel, delay):
+    await asyncio.sleep(delay)
+    _panel_pending.pop(channel.id, None)
+    await _repost_panel(channel)
+
+
+async def _repost_panel(channel):
+    _panel_last_posted[channel.id] = time.monotonic()
+    old_id = panel_messages.get(channel.id)
+    if old_id is not None:
+        try:
+            async with rest_scheduler.slot("interactive", "DELETE /channels/:id/messages/:id"):
+                await channel.get_partial_message(old_id).delete()
+            logger.info(f"Deleted old panel message with ID {old_id}.")
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            logger.error(f"Error deleting old panel message: {e}")
+    elif channel.id not in _panel_scanned_channels:
+        # パネルIDが未記録のチャンネルだけ、起動後一度だけ履歴から古いパネルを探して消す
+        _panel_scanned_channels.add(channel.id)
+        await _delete_panels_from_history(channel)
+
+    embed = create_panel_embed()
+    view = CombinedView()
+    try:
+        async with rest_scheduler.slot("interactive", "POST /channels/:id/messages"):
+            sent_msg = await channel.send(embed=embed, view=view)
+    except discord.HTTPException as e:
+        logger.error(f"Error sending panel message: {e}")
+        return
+    panel_messages[channel.id] = sent_msg.id
+    logger.info(f"Sent new panel message with ID {sent_msg.id}.")
+    await _save_panel_message(channel.id, sent_msg.id)
 
 
-async def send_panel(channel):
-    global current_panel_message_id
+async def _delete_panels_from_history(channel):
     try:
         async for msg in channel.history(limit=100):
             if msg.author == bot.user and msg.embeds:
                 embed = msg.embeds[0]
-                if embed.title == "🎯 エロ漫画ルーレット":
+                if embed.title == PANEL_TITLE:
                     await msg.delete()
                     logger.info(f"Deleted old panel message with ID {msg.id}.")
     except Exception as e:
         logger.error(f"Error deleting old panel messages: {e}")
 
-    embed = create_panel_embed()
-    view = CombinedView()
+
+@db_timed
+async def load_panel_messages():
+    pool = get_db_pool()
+    if not pool:
+        return
     try:
-        sent_msg = await channel.send(embed=embed, view=view)
-        current_panel_message_id = sent_msg.id
-        logger.info(f"Sent new panel message with ID {current_panel_message_id}.")
-    except discord.HTTPException as e:
-        logger.error(f"Error sending panel message: {e}")
+        rows = await pool.fetch("SELECT channel_id, message_id FROM panel_messages")
+    except DB_ERRORS as e:
+        logger.error(f"Error loading panel messages: {e}")
+        return
+    panel_messages.update((row["channel_id"], row["message_id"]) for row in rows)
+
+
+@db_timed
+async def _save_panel_message(channel_id, message_id):
+    pool = get_db_pool()
+    if not pool:
+        return
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO panel_messages (channel_id, message_id)
+                    VALUES ($1, $2)
+                    ON CONFLICT (channel_id) DO UPDATE SET
+                        message_id = EXCLUDED.message_id,
+                        updated_at = now()
+                """, channel_id, message_id)
+                await publish_changes(conn, panel=[channel_id, message_id])
+    except DB_ERRORS as e:
+        logger.error(f"Error saving panel message: {e}")
 
 
 def create_panel_embed():
     embed = discord.Embed(
-        title="🎯 エロ漫画ルーレット",
+        title=PANEL_TITLE,
         description=(
             "ボタンを押してエロ漫画を選んでください！<a:c296:1288305823323263029>\n\n"
             "🔵：自分の <:b431:1289782471197458495> を除外しない\n"
@@ -507,11 +2971,41 @@ async def embed_command(interaction: discord.Interaction):
     channel = interaction.channel
     if channel:
         await interaction.response.send_message("パネルを表示します！", ephemeral=True)
-        await send_panel(channel)
+        await send_panel(channel, force=True)
     else:
         await interaction.response.send_message("エラー: チャンネルが取得できませんでした。", ephemeral=True)
 
 
+@bot.tree.command(name="roulette_add", description="スレッドをルーレットの対象に登録し、このチャンネルにパネルを置けるようにします。")
+@app_commands.default_permissions(manage_guild=True)
+async def roulette_add_command(interaction: discord.Interaction, thread: discord.Thread):
+    config = RouletteThread(thread.id, thread.guild.id, interaction.channel_id)
+    if not await save_roulette_thread(config):
+        await interaction.response.send_message("スレッドの登録中にエラーが発生しました。", ephemeral=True)
+        return
+    _register_thread(config)
+    await interaction.response.send_message(
+        f"{thread.mention} をルーレットの対象に登録しました。/embed でパネルを表示できます。", ephemeral=True
+    )
+    logger.info(f"Registered roulette thread {thread.id} (panel channel {interaction.channel_id}).")
+    await load_message_catalog(thread.id)
+    asyncio.create_task(sync_thread(thread.id))
+
+
+@bot.tree.command(name="roulette_remove", description="スレッドをルーレットの対象から外します。")
+@app_commands.default_permissions(manage_guild=True)
+async def roulette_remove_command(interaction: discord.Interaction, thread: discord.Thread):
+    if thread.id not in roulette_threads:
+        await interaction.response.send_message("そのスレッドは登録されていません。", ephemeral=True)
+        return
+    if not await delete_roulette_thread(thread.id):
+        await interaction.response.send_message("スレッドの登録解除中にエラーが発生しました。", ephemeral=True)
+        return
+    _unregister_thread(thread.id)
+    await interaction.response.send_message(f"{thread.mention} をルーレットの対象から外しました。", ephemeral=True)
+    logger.info(f"Unregistered roulette thread {thread.id}.")
+
+
 @bot.tree.command(name="check", description="特定のメッセージのリアクションを表示します。")
 async def check_command(interaction: discord.Interaction, message_id: str):
     try:
@@ -521,7 +3015,7 @@ async def check_command(interaction: discord.Interaction, message_id: str):
         return
 
     try:
-        reactions = await asyncio.to_thread(_fetch_reactions_sync, msg_id)
+        reactions = await fetch_reactions(msg_id)
     except Exception as e:
         logger.error(f"Error fetching reactions for message_id={msg_id}: {e}")
         await interaction.response.send_message("リアクション取得中にエラーが発生しました。", ephemeral=True)
@@ -556,12 +3050,91 @@ async def check_command(interaction: discord.Interaction, message_id: str):
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
+@bot.tree.command(name="stats", description="お気に入りが多い投稿と投稿が多い作者を表示します。")
+async def stats_command(interaction: discord.Interaction):
+    thread_id = thread_for_channel(interaction.channel_id)
+    if thread_id is None:
+        await interaction.response.send_message("このチャンネルはルーレットの対象に登録されていません。", ephemeral=True)
+        return
+    stats = await fetch_thread_stats(thread_id)
+    if stats is None:
+        await interaction.response.send_message("統計の取得中にエラーが発生しました。", ephemeral=True)
+        return
+    favorites, authors = stats
+    guild_id = thread_guild_id(thread_id, interaction.guild_id)
+    embed = discord.Embed(title="ルーレット統計", color=0xFF69B4)
+    embed.add_field(
+        name="お気に入りが多い投稿 <:b435:1304690627723657267>",
+        value="\n".join(
+            f"{rank}. {count} 件 https://discord.com/channels/{guild_id}/{thread_id}/{message_id}"
+            for rank, (message_id, count) in enumerate(favorites, 1)
+        ) or "まだありません。",
+        inline=False
+    )
+    embed.add_field(
+        name="投稿が多い作者",
+        value="\n".join(
+            f"{rank}. {author_display_name(author_id)} さん: {post_count} 件"
+            for rank, (author_id, post_count) in enumerate(authors, 1)
+        ) or "まだありません。",
+        inline=False
+    )
+    await interaction.response.send_message(embed=embed)
+
+
+@bot.tree.command(name="mystats", description="あなたの「あとで読む」とお気に入りの数を表示します。")
+async def mystats_command(interaction: discord.Interaction):
+    thread_id = thread_for_channel(interaction.channel_id)
+    if thread_id is None:
+        await interaction.response.send_message("このチャンネルはルーレットの対象に登録されていません。", ephemeral=True)
+        return
+    counts = await fetch_user_stats(interaction.user.id, thread_id)
+    if counts is None:
+        await interaction.response.send_message("統計の取得中にエラーが発生しました。", ephemeral=True)
+        return
+    await interaction.response.send_message(
+        f"あとで読む <:b434:1304690617405669376>：{counts.get(READ_LATER_REACTION_ID, 0)} 件\n"
+        f"お気に入り <:b435:1304690627723657267>：{counts.get(FAVORITE_REACTION_ID, 0)} 件",
+        ephemeral=True
+    )
+
+
+@bot.tree.command(name="search", description="保存済みの投稿を本文(タイトル・作者タグ・サークル名など)で検索します。")
+async def search_command(interaction: discord.Interaction, query: str):
+    thread_id = thread_for_channel(interaction.channel_id)
+    if thread_id is None:
+        await interaction.response.send_message("このチャンネルはルーレットの対象に登録されていません。", ephemeral=True)
+        return
+    if not search_terms(query):
+        await interaction.response.send_message("検索語を入力してください。", ephemeral=True)
+        return
+    guild_id = thread_guild_id(thread_id, interaction.guild_id)
+    view = SearchView(thread_id, query.strip(), guild_id)
+    embed = await view.render()
+    if embed is None:
+        await interaction.response.send_message("検索中にエラーが発生しました。", ephemeral=True)
+        return
+    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
+
+# thread_id -> 実行中のバックフィルタスク
+backfill_tasks = {}
+
+
 @bot.tree.command(name="save", description="既存のメッセージのリアクションをデータベースに保存します。")
 async def save_command(interaction: discord.Interaction):
     try:
         logger.info(f"/save command invoked by user_id={interaction.user.id}")
+        thread_id = thread_for_channel(interaction.channel_id)
+        if thread_id is None:
+            await interaction.response.send_message("このチャンネルはルーレットの対象に登録されていません。", ephemeral=True)
+            return
+        task = backfill_tasks.get(thread_id)
+        if task and not task.done():
+            await interaction.response.send_message("リアクションの移行はすでに実行中です。", ephemeral=True)
+            return
         await interaction.response.send_message("リアクションの移行を開始します。しばらくお待ちください...", ephemeral=True)
-        asyncio.create_task(run_db_save(interaction))
+        backfill_tasks[thread_id] = asyncio.create_task(run_db_save(interaction, thread_id))
     except Exception as e:
         logger.error(f"Unexpected error in save_command: {e}", exc_info=True)
         if not interaction.response.is_done():
@@ -570,111 +3143,213 @@ async def save_command(interaction: discord.Interaction):
             await interaction.followup.send("リアクションの移行中に予期しないエラーが発生しました。", ephemeral=True)
 
 
-async def run_db_save(interaction: discord.Interaction):
+async def run_db_save(interaction: discord.Interaction, thread_id):
+    """
+    スレッドの全履歴を新しい順にストリーミングし、メッセージとリアクションをページ単位で一括保存する。
+    ページごとに backfill_state へ進捗を記録するので、中断しても続きから再開できる。
+    """
     try:
-        logger.info("run_db_save task started.")
-        channel = bot.get_channel(THREAD_ID)
+        logger.info(f"run_db_save task started for thread_id={thread_id}.")
+        channel = await resolve_channel(thread_id)
         if channel is None:
-            await interaction.followup.send("指定したTHREAD_IDのチャンネルが見つかりませんでした。", ephemeral=True)
-            logger.error("Specified THREAD_ID channel not found.")
+            await interaction.followup.send("対象スレッドのチャンネルが見つかりませんでした。", ephemeral=True)
+            logger.error(f"Roulette thread {thread_id} not found.")
             return
 
-        all_messages = []
-        try:
-            async for msg in channel.history(limit=None):
-                all_messages.append(msg)
-            logger.debug(f"Fetched {len(all_messages)} messages.")
-        except discord.HTTPException as e:
-            logger.error(f"Error fetching message history for migration: {e}")
-            await interaction.followup.send("メッセージ履歴の取得中にエラーが発生しました。", ephemeral=True)
-            return
+        state = await _get_backfill_state(thread_id)
+        before_id, processed = state if state else (None, 0)
+        if before_id is not None:
+            await send_followup(interaction, f"前回の続き({processed} 件処理済み)から再開します。")
 
-        success_count = 0
-        for message in all_messages:
-            await ensure_message_in_db(message)
+        total = getattr(channel, "message_count", None)
+        started = time.monotonic()
+        resumed_from = processed
+        last_report = started
+        before = discord.Object(id=before_id) if before_id is not None else None
+        while True:
             try:
-                fetched_msg = await channel.fetch_message(message.id)
-                for reaction in fetched_msg.reactions:
-                    if isinstance(reaction.emoji, discord.Emoji):
-                        if reaction.emoji.id not in REACTIONS.values():
-                            continue
-                        emoji_id = reaction.emoji.id
-                    else:
-                        continue
-                    async for user in reaction.users():
-                        if user.id == bot.user.id:
-                            continue
-                        await update_reactions_in_db(message.id, emoji_id, user.id, add=True)
-                success_count += 1
-                await asyncio.sleep(0.1)
+                async with rest_scheduler.slot("background", "GET /channels/:id/messages"):
+                    page = [msg async for msg in channel.history(limit=100, before=before)]
             except discord.HTTPException as e:
-                logger.error(f"Error fetching reactions for message_id={message.id}: {e}")
+                logger.error(f"Error fetching message history for migration: {e}")
+                await send_followup(interaction, "メッセージ履歴の取得中にエラーが発生しました。再度 /save で続きから再開できます。")
+                return
+            if not page:
+                break
 
-        await interaction.followup.send(
-            f"リアクションの移行が完了しました。{success_count} 件のメッセージを処理しました。",
-            ephemeral=True
-        )
-        logger.info(f"/save command completed successfully. Processed {success_count} messages.")
+            reactions = await asyncio.gather(*(
+                _fetch_reaction_users(message, reaction)
+                for message in page
+                for reaction in message.reactions
+                if getattr(reaction.emoji, "id", None) in REACTIONS.values()
+            ))
+            rows = [row for chunk in reactions for row in chunk]
+            if not await save_backfill_page(page, rows):
+                await send_followup(interaction, "DBへの保存中にエラーが発生しました。再度 /save で続きから再開できます。")
+                return
+
+            processed += len(page)
+            before = page[-1]
+            await _set_backfill_state(thread_id, before.id, processed)
+
+            now = time.monotonic()
+            if now - last_report >= BACKFILL_PROGRESS_INTERVAL:
+                last_report = now
+                await send_followup(interaction, _backfill_progress(processed, resumed_from, total, now - started))
+
+        await _set_backfill_state(thread_id, None, processed, completed=True)
+        await send_followup(interaction, f"リアクションの移行が完了しました。{processed} 件のメッセージを処理しました。")
+        logger.info(f"/save command completed successfully. Processed {processed} messages.")
     except Exception as e:
         logger.error(f"Unexpected error in run_db_save task: {e}", exc_info=True)
-        await interaction.followup.send("リアクションの移行中に予期しないエラーが発生しました。", ephemeral=True)
+        await send_followup(interaction, "リアクションの移行中に予期しないエラーが発生しました。")
+
+
+async def send_followup(interaction, content):
+    # インタラクションのトークンは15分で失効するため、長時間のバックフィルでは送れなくなる
+    try:
+        await interaction.followup.send(content, ephemeral=True)
+    except discord.HTTPException as e:
+        logger.warning(f"Could not send followup ({e}): {content}")
+
+
+def _backfill_progress(processed, resumed_from, total, elapsed):
+    rate = (processed - resumed_from) / elapsed if elapsed > 0 else 0
+    text = f"{processed} 件処理済み({rate:.1f} 件/秒)"
+    if total and rate > 0 and total > processed:
+        eta = timedelta(seconds=int((total - processed) / rate))
+        text += f"、残り約 {eta}"
+    return text
+
+
+async def _fetch_reaction_users(message, reaction):
+    """履歴に含まれる reaction から、対象絵文字を付けたユーザーをページングして取得する。"""
+    if reaction.count - (1 if reaction.me else 0) <= 0:
+        return []
+    async with rest_scheduler.slot("background", "GET /channels/:id/messages/:id/reactions/:emoji"):
+        try:
+            return [
+                (message.id, reaction.emoji.id, user.id)
+                async for user in reaction.users(limit=None)
+                if user.id != bot.user.id
+            ]
+        except discord.HTTPException as e:
+            logger.error(f"Error fetching reactions for message_id={message.id}: {e}")
+            return []
+
+
+async def save_backfill_page(messages, reaction_rows):
+    rows = [(m.id, m.channel.id, m.author.id, m.content) for m in messages]
+    if not await write_reaction_batch(rows, dict.fromkeys(reaction_rows, True)):
+        return False
+    if not messages:
+        return True
+    message_catalog = message_catalogs.get(messages[0].channel.id)
+    if message_catalog is not None:
+        for message in messages:
+            message_catalog.add_message(message.id, message.author.id)
+        for message_id, emoji_id, user_id in reaction_rows:
+            message_catalog.apply_reaction(message_id, emoji_id, user_id, True)
+    return True
+
+
+@db_timed
+async def _get_backfill_state(thread_id):
+    """未完了のバックフィルがあれば (次に取得する before の message_id, 処理済み件数) を返す。"""
+    pool = get_db_pool()
+    if not pool:
+        return None
+    try:
+        row = await pool.fetchrow("""
+            SELECT before_message_id, processed FROM backfill_state
+            WHERE thread_id = $1 AND completed_at IS NULL
+        """, thread_id)
+    except DB_ERRORS as e:
+        logger.error(f"Error reading backfill state: {e}")
+        return None
+    return (row["before_message_id"], row["processed"]) if row else None
+
+
+@db_timed
+async def _set_backfill_state(thread_id, before_message_id, processed, completed=False):
+    pool = get_db_pool()
+    if not pool:
+        return
+    try:
+        await pool.execute("""
+            INSERT INTO backfill_state (thread_id, before_message_id, processed, completed_at)
+            VALUES ($1, $2, $3, CASE WHEN $4::BOOLEAN THEN now() END)
+            ON CONFLICT (thread_id) DO UPDATE SET
+                before_message_id = EXCLUDED.before_message_id,
+                processed = EXCLUDED.processed,
+                started_at = CASE WHEN backfill_state.completed_at IS NOT NULL
+                                  THEN now() ELSE backfill_state.started_at END,
+                updated_at = now(),
+                completed_at = EXCLUDED.completed_at
+        """, thread_id, before_message_id, processed, completed)
+    except DB_ERRORS as e:
+        logger.error(f"Error updating backfill state: {e}")
 
 
 ########################
 # リアクションイベント
 ########################
+def is_tracked_reaction(payload):
+    if payload.user_id == bot.user.id:
+        return False
+    # Rawイベントの絵文字は PartialEmoji なので id で判定する(Unicode絵文字は id が None)
+    return payload.emoji.id in REACTIONS.values()
+
+
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
-    logger.info(f"on_raw_reaction_add fired: emoji={payload.emoji}, user_id={payload.user_id}, message_id={payload.message_id}")
+    hot_log.info(
+        "on_raw_reaction_add",
+        f"on_raw_reaction_add fired: emoji={payload.emoji}, user_id={payload.user_id}, message_id={payload.message_id}",
+        emoji_id=payload.emoji.id, user_id=payload.user_id, message_id=payload.message_id
+    )
 
-    if payload.user_id == bot.user.id:
+    if not is_tracked_reaction(payload):
         return
 
-    if isinstance(payload.emoji, discord.Emoji):
-        if payload.emoji.id not in REACTIONS.values():
+    message_catalog = message_catalogs.get(payload.channel_id)
+    if message_catalog is None or payload.message_id not in message_catalog:
+        channel = bot.get_channel(payload.channel_id)
+        if not channel:
+            logger.info("channel is None, cannot process reaction.")
             return
-    else:
-        return
 
-    channel = bot.get_channel(payload.channel_id)
-    if not channel:
-        logger.info("channel is None, cannot process reaction.")
-        return
+        async with rest_scheduler.slot("reaction", "GET /channels/:id/messages/:id"):
+            message = await safe_fetch_message(channel, payload.message_id)
+        if not message:
+            logger.info(f"message_id={payload.message_id} not found in channel.")
+            return
 
-    message = await safe_fetch_message(channel, payload.message_id)
-    if not message:
-        logger.info(f"message_id={payload.message_id} not found in channel.")
-        return
+        reaction_queue.put_message(message)
+        if message_catalog is not None:
+            message_catalog.add_message(message.id, message.author.id)
 
-    await ensure_message_in_db(message)
-    await update_reactions_in_db(payload.message_id, payload.emoji.id, payload.user_id, add=True)
+    reaction_queue.put(payload.message_id, payload.emoji.id, payload.user_id, add=True)
+    if message_catalog is not None:
+        message_catalog.apply_reaction(payload.message_id, payload.emoji.id, payload.user_id, add=True)
 
 
 @bot.event
 async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
-    logger.info(f"on_raw_reaction_remove fired: emoji={payload.emoji}, user_id={payload.user_id}, message_id={payload.message_id}")
-
-    if payload.user_id == bot.user.id:
-        return
-
-    if isinstance(payload.emoji, discord.Emoji):
-        if payload.emoji.id not in REACTIONS.values():
-            return
-    else:
-        return
-
-    channel = bot.get_channel(payload.channel_id)
-    if not channel:
-        logger.info("channel is None, cannot process reaction removal.")
-        return
+    hot_log.info(
+        "on_raw_reaction_remove",
+        f"on_raw_reaction_remove fired: emoji={payload.emoji}, user_id={payload.user_id}, message_id={payload.message_id}",
+        emoji_id=payload.emoji.id, user_id=payload.user_id, message_id=payload.message_id
+    )
 
-    message = await safe_fetch_message(channel, payload.message_id)
-    if not message:
-        logger.info(f"message_id={payload.message_id} not found in channel.")
+    if not is_tracked_reaction(payload):
         return
 
-    await ensure_message_in_db(message)
-    await update_reactions_in_db(payload.message_id, payload.emoji.id, payload.user_id, add=False)
+    # 削除は該当行が無ければ何もしないので、メッセージの取得・保存は不要
+    reaction_queue.put(payload.message_id, payload.emoji.id, payload.user_id, add=False)
+    message_catalog = message_catalogs.get(payload.channel_id)
+    if message_catalog is not None:
+        message_catalog.apply_reaction(payload.message_id, payload.emoji.id, payload.user_id, add=False)
 
 
 ########################
@@ -695,6 +3370,11 @@ async def on_message(message):
     if message.author == bot.user:
         return
 
+    message_catalog = message_catalogs.get(message.channel.id)
+    if message_catalog is not None:
+        reaction_queue.put_message(message)
+        message_catalog.add_message(message.id, message.author.id)
+
     if message.channel.id in target_channel_ids and message.mentions:
         for user in message.mentions:
             if user.voice and user.voice.channel:
@@ -708,108 +3388,471 @@ async def on_message(message):
                     await message.channel.send(f"エラーが発生しました: {e}")
 
     if message.content == "バルス":
-        now = datetime.utcnow()
-        deleted_count = 0
-        async for msg in message.channel.history(limit=None, after=now - timedelta(hours=1)):
-            if msg.author.id == message.author.id:
-                try:
-                    await msg.delete()
-                    deleted_count += 1
-                    if deleted_count % 10 == 0:
-                        await asyncio.sleep(0.5)
-                except (discord.Forbidden, discord.HTTPException) as e:
-                    await message.channel.send(f"メッセージ削除中にエラーが発生しました: {e}")
-                    logger.error(f"エラー発生: {e}")
-                    return
-
-        await message.channel.send(
-            f"過去1時間以内にあなたが送信したメッセージを{deleted_count}件削除しました。",
-            delete_after=2
-        )
-        logger.info(f"{deleted_count}件のメッセージを削除しました。")
+        key = (message.channel.id, message.author.id)
+        if key in balus_jobs and not balus_jobs[key].done():
+            await message.channel.send(f"{message.author.mention} 削除はすでに実行中です。", delete_after=2)
+        else:
+            task = asyncio.create_task(run_balus(message))
+            balus_jobs[key] = task
+            task.add_done_callback(lambda _: balus_jobs.pop(key, None))
 
     await bot.process_commands(message)
 
 
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    if payload.channel_id not in roulette_threads or "content" not in payload.data:
+        return
+    reaction_queue.put_edit(payload.message_id, payload.data["content"])
+
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    message_catalog = message_catalogs.get(payload.channel_id)
+    if message_catalog is None:
+        return
+    reaction_queue.put_delete((payload.message_id,))
+    message_catalog.remove_message(payload.message_id)
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    message_catalog = message_catalogs.get(payload.channel_id)
+    if message_catalog is None:
+        return
+    reaction_queue.put_delete(payload.message_ids)
+    for message_id in payload.message_ids:
+        message_catalog.remove_message(message_id)
+
+
+########################
+# バルス(一括削除)
+########################
+# 一括削除APIは作成から14日以内のメッセージにしか使えない(境界ぎりぎりは余裕を持たせる)
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+BULK_DELETE_CHUNK = 100
+
+# (channel_id, user_id) -> 実行中の削除タスク
+balus_jobs = {}
+
+
+async def run_balus(message):
+    """
+    バックグラウンドで、発言者が直近 BALUS_WINDOW_HOURS 時間に送ったメッセージを削除する。
+    14日以内のものは100件ずつ一括削除し、失敗したチャンクや古いものだけ1件ずつ削除する。
+    一部が失敗しても残りの削除は続ける。
+    """
+    channel = message.channel
+    author_id = message.author.id
+    deleted = failed = 0
+    status = None
+    try:
+        after = discord.utils.utcnow() - timedelta(hours=BALUS_WINDOW_HOURS)
+        async with rest_scheduler.slot("background", "GET /channels/:id/messages"):
+            targets = [
+                msg async for msg in channel.history(limit=None, after=after)
+                if msg.author.id == author_id
+            ]
+        logger.info(f"Balus started: channel_id={channel.id}, user_id={author_id}, targets={len(targets)}")
+        if len(targets) > BULK_DELETE_CHUNK:
+            status = await channel.send(f"{message.author.mention} {len(targets)} 件のメッセージを削除しています...")
+
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        bulk = [msg for msg in targets if msg.created_at > cutoff]
+        single = [msg for msg in targets if msg.created_at <= cutoff]
+        last_report = time.monotonic()
+        for i in range(0, len(bulk), BULK_DELETE_CHUNK):
+            chunk = bulk[i:i + BULK_DELETE_CHUNK]
+            ok, ng = await _bulk_delete(channel, chunk)
+            deleted += ok
+            failed += ng
+            now = time.monotonic()
+            if status is not None and now - last_report >= BALUS_PROGRESS_INTERVAL:
+                last_report = now
+                await _edit_balus_status(status, f"{message.author.mention} 削除中... {deleted}/{len(targets)} 件")
+        for msg in single:
+            if await _delete_one(msg):
+                deleted += 1
+            else:
+                failed += 1
+    except discord.HTTPException as e:
+        logger.error(f"Error reading history for balus: {e}")
+        failed = -1
+    except Exception as e:
+        logger.error(f"Unexpected error in run_balus: {e}", exc_info=True)
+        failed = -1
+
+    text = f"過去{BALUS_WINDOW_HOURS:g}時間以内にあなたが送信したメッセージを{deleted}件削除しました。"
+    if failed > 0:
+        text += f"({failed}件は削除できませんでした)"
+    elif failed < 0:
+        text += "(途中でエラーが発生したため中断しました)"
+    try:
+        if status is not None:
+            await status.delete()
+        await channel.send(text, delete_after=2)
+    except discord.HTTPException as e:
+        logger.warning(f"Could not send balus result: {e}")
+    logger.info(f"Balus finished: channel_id={channel.id}, user_id={author_id}, deleted={deleted}, failed={failed}")
+
+
+async def _bulk_delete(channel, messages):
+    """100件までを1回のAPI呼び出しで削除する。失敗した場合は1件ずつ削除し直す。(成功数, 失敗数) を返す。"""
+    if len(messages) >= 2:
+        try:
+            async with rest_scheduler.slot("background", "POST /channels/:id/messages/bulk-delete"):
+                await channel.delete_messages(messages)
+            return len(messages), 0
+        except discord.NotFound:
+            # 既に消えていたメッセージが混じっていると一括削除全体が失敗するので、個別に削除し直す
+            pass
+        except discord.HTTPException as e:
+            logger.warning(f"Bulk delete of {len(messages)} messages failed, falling back to single deletes: {e}")
+    results = [await _delete_one(msg) for msg in messages]
+    ok = sum(results)
+    return ok, len(results) - ok
+
+
+async def _delete_one(msg):
+    try:
+        async with rest_scheduler.slot("background", "DELETE /channels/:id/messages/:id"):
+            await msg.delete()
+        return True
+    except discord.NotFound:
+        # 既に削除済みなら成功扱い
+        return True
+    except discord.HTTPException as e:
+        logger.warning(f"Failed to delete message {msg.id}: {e}")
+        return False
+
+
+async def _edit_balus_status(status, content):
+    try:
+        await status.edit(content=content)
+    except discord.HTTPException as e:
+        logger.debug(f"Could not update balus status: {e}")
+
+
 ########################
 # メッセージ履歴同期タスク
 ########################
-@tasks.loop(minutes=5)
+# 新着・編集・削除は Gateway イベントで即時に書き込むので、ここでは切断中などの取りこぼしだけを補う
+@tasks.loop(minutes=SYNC_RECONCILE_INTERVAL_MINUTES)
 async def save_all_messages_to_db_task():
-    await save_all_messages_to_db()
+    # 複数プロセスで動かしているときは、advisory lock を持つリーダーだけが同期する
+    if await cluster.is_leader():
+        await save_all_messages_to_db()
+
 
+async def save_all_messages_to_db(full=None):
+    """登録済みの全スレッドを順に同期する。"""
+    for thread_id in list(roulette_threads):
+        await sync_thread(thread_id, full)
 
-async def save_all_messages_to_db():
-    channel = bot.get_channel(THREAD_ID)
+
+async def sync_thread(thread_id, full=None):
+    """
+    スレッドの新着メッセージをDBへ取り込む。
+    通常は保存済みの最新 message_id (high-water mark) より後だけを取得し、
+    full=True または FULL_SYNC_INTERVAL_HOURS ごとにのみ全履歴をID範囲ごとに照合して、
+    オフライン中の編集・削除も反映する。
+    """
+    channel = await resolve_channel(thread_id)
     if channel is None:
-        logger.error("指定したTHREAD_IDのチャンネルが見つかりませんでした。")
+        logger.error(f"Roulette thread {thread_id} not found.")
         return
 
-    all_messages = []
-    last_msg = None
-    batch_size = 50
-    try:
-        while True:
-            batch = []
-            async for msg in channel.history(limit=batch_size, before=last_msg):
-                batch.append(msg)
-            if not batch:
-                break
-            all_messages.extend(batch)
-            last_msg = batch[-1]
-            await asyncio.sleep(1.0)
+    state = await _get_sync_state(thread_id)
+    if state is None:
+        return
+    high_water_mark, last_full_sync_at = state
+
+    if full is None:
+        full = high_water_mark is None or _full_sync_due(last_full_sync_at)
 
-        if all_messages:
-            await bulk_save_messages_to_db(all_messages)
-        logger.info(f"Saved total {len(all_messages)} messages to the database (paging).")
+    mode = "full" if full else "incremental"
+    try:
+        with SYNC_SECONDS.time(mode):
+            if full:
+                saved = await _reconcile_history(channel)
+            else:
+                saved = await _sync_after(channel, high_water_mark)
+        SYNC_ROWS.inc(mode, amount=saved)
+        logger.info(f"Saved total {saved} messages of thread {thread_id} to the database ({mode}).")
     except discord.HTTPException as e:
         logger.error(f"Error fetching message history in paging: {e}")
 
 
-async def bulk_save_messages_to_db(messages):
-    if not messages:
+def _full_sync_due(last_full_sync_at):
+    if FULL_SYNC_INTERVAL_HOURS <= 0:
+        return False
+    if last_full_sync_at is None:
+        return True
+    return datetime.now(last_full_sync_at.tzinfo) - last_full_sync_at >= timedelta(hours=FULL_SYNC_INTERVAL_HOURS)
+
+
+async def _sync_after(channel, high_water_mark, batch_size=100):
+    """high-water mark より新しいメッセージを古い順にページングし、ページごとに保存する。"""
+    saved = 0
+    after = discord.Object(id=high_water_mark)
+    while True:
+        async with rest_scheduler.slot("background", "GET /channels/:id/messages"):
+            batch = [msg async for msg in channel.history(limit=batch_size, after=after, oldest_first=True)]
+        if not batch:
+            break
+        if not await bulk_save_messages_to_db(batch):
+            break
+        newest_id = max(msg.id for msg in batch)
+        await _set_sync_state(channel.id, newest_id)
+        saved += len(batch)
+        if len(batch) < batch_size:
+            break
+        after = discord.Object(id=newest_id)
+    return saved
+
+
+async def _reconcile_history(channel, batch_size=100):
+    """
+    全履歴を新しい順にページングし、RECONCILE_RANGE_HOURS ごとのID範囲単位で件数とハッシュを
+    前回照合した値(range_checksums)と比べる。一致した範囲はDBに触れず、
+    違った範囲だけDBの行を読み直して、追加・編集・削除を反映する。
+    """
+    thread_id = channel.id
+    known = await _get_range_checksums(thread_id)
+    if known is None:
+        return 0
+    walked = 0
+    top_id = None
+    seen = []
+    current_key, current = None, []
+    before = None
+    while True:
+        # 固定の待ち時間は入れず、rest_scheduler が上位レーンの待ちとレート制限の残りに合わせて間隔を空ける
+        async with rest_scheduler.slot("background", "GET /channels/:id/messages"):
+            batch = [msg async for msg in channel.history(limit=batch_size, before=before)]
+        if not batch:
+            break
+        if top_id is None:
+            top_id = batch[0].id
+        for msg in batch:
+            key = _range_key(msg.id)
+            if key != current_key:
+                if current_key is not None and not await _reconcile_range(thread_id, current_key, current, known, top_id):
+                    return walked
+                seen.append(key)
+                current_key, current = key, []
+            current.append(msg)
+        walked += len(batch)
+        before = batch[-1]
+    if current_key is not None and not await _reconcile_range(thread_id, current_key, current, known, top_id):
+        return walked
+    if top_id is not None:
+        # 1件も残っていない範囲はページに現れないので、まとめて削除扱いにする
+        await _tombstone_unseen_ranges(thread_id, seen, top_id)
+    await _set_sync_state(thread_id, top_id, True)
+    return walked
+
+
+def _range_key(message_id):
+    # snowflake の上位ビットは 2015年からのミリ秒なので、ID範囲がそのまま投稿時刻の範囲になる
+    return (message_id >> 22) // RECONCILE_RANGE_MS
+
+
+def _range_bounds(key):
+    return (key * RECONCILE_RANGE_MS) << 22, (((key + 1) * RECONCILE_RANGE_MS) << 22) - 1
+
+
+def _range_checksum(messages):
+    """(件数, 各メッセージの (id, 本文) のハッシュの XOR) を返す。順序に依存しない。"""
+    checksum = 0
+    for msg in messages:
+        digest = hashlib.blake2b(f"{msg.id}:{msg.content}".encode(), digest_size=8).digest()
+        checksum ^= int.from_bytes(digest, "big", signed=True)
+    return len(messages), checksum
+
+
+async def _reconcile_range(thread_id, key, messages, known, top_id):
+    count, checksum = _range_checksum(messages)
+    if known.get(key) == (count, checksum):
+        RECONCILE_RANGES.inc("match")
+        return True
+    RECONCILE_RANGES.inc("differ")
+    lo, hi = _range_bounds(key)
+    # 走査開始後に投稿されたメッセージはページに含まれないので比較対象から外す
+    stored = await _fetch_range_contents(thread_id, lo, min(hi, top_id))
+    if stored is None:
+        return False
+    current = {msg.id: msg for msg in messages}
+    rows = [(m.id, m.channel.id, m.author.id, m.content) for m in messages if m.id not in stored]
+    edits = {
+        message_id: current[message_id].content
+        for message_id, content in stored.items()
+        if message_id in current and (content or "") != current[message_id].content
+    }
+    deletes = set(stored) - set(current)
+    if rows or edits or deletes:
+        if not await write_reaction_batch(rows, {}, edits, deletes):
+            return False
+        message_catalog = message_catalogs.get(thread_id)
+        if message_catalog is not None:
+            for message_id, _, author_id, _ in rows:
+                message_catalog.add_message(message_id, author_id)
+            for message_id in deletes:
+                message_catalog.remove_message(message_id)
+        logger.info(
+            f"Reconciled range {key} of thread {thread_id}: "
+            f"{len(rows)} missing, {len(edits)} edited, {len(deletes)} deleted."
+        )
+    await _set_range_checksum(thread_id, key, count, checksum)
+    return True
+
+
+@db_timed
+async def _get_range_checksums(thread_id):
+    pool = get_db_pool()
+    if not pool:
+        return None
+    try:
+        rows = await pool.fetch(
+            "SELECT range_start, message_count, checksum FROM range_checksums WHERE thread_id = $1", thread_id
+        )
+    except DB_ERRORS as e:
+        logger.error(f"Error reading range checksums: {e}")
+        return None
+    return {row["range_start"]: (row["message_count"], row["checksum"]) for row in rows}
+
+
+@db_timed
+async def _set_range_checksum(thread_id, key, count, checksum):
+    pool = get_db_pool()
+    if not pool:
         return
     try:
-        await asyncio.to_thread(_bulk_save_messages_to_db_sync, messages)
-    except Exception as e:
-        logger.error(f"Error during bulk save of messages: {e}")
+        await pool.execute("""
+            INSERT INTO range_checksums (thread_id, range_start, message_count, checksum)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (thread_id, range_start) DO UPDATE SET
+                message_count = EXCLUDED.message_count,
+                checksum = EXCLUDED.checksum,
+                verified_at = now()
+        """, thread_id, key, count, checksum)
+    except DB_ERRORS as e:
+        logger.error(f"Error saving range checksum: {e}")
+
+
+@db_timed
+async def _fetch_range_contents(thread_id, lo, hi):
+    """削除されていない message_id -> content を返す。"""
+    pool = get_db_pool()
+    if not pool:
+        return None
+    try:
+        rows = await pool.fetch("""
+            SELECT message_id, content FROM messages
+            WHERE thread_id = $1 AND message_id BETWEEN $2 AND $3 AND deleted_at IS NULL
+        """, thread_id, lo, hi)
+    except DB_ERRORS as e:
+        logger.error(f"Error reading messages for reconciliation: {e}")
+        return None
+    return {row["message_id"]: row["content"] for row in rows}
 
 
-def _bulk_save_messages_to_db_sync(messages):
-    conn = get_db_connection()
-    if not conn:
+@db_timed
+async def _tombstone_unseen_ranges(thread_id, seen, top_id):
+    pool = get_db_pool()
+    if not pool:
         return
     try:
-        data = []
-        for message in messages:
-            data.append((message.id, message.channel.id, message.author.id, message.content))
-            logger.debug(f"Bulk saving message_id={message.id} to DB without reactions.")
-
-        with conn.cursor() as cur:
-            cur.executemany("""
-                INSERT INTO messages (message_id, thread_id, author_id, content)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (message_id) DO NOTHING
-            """, data)
-            conn.commit()
-
-        logger.info(f"Bulk inserted {len(messages)} messages without reactions.")
-    except Error as e:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                deleted_ids = await tombstone_messages(
+                    conn, "thread_id = $1 AND message_id <= $2 AND ((message_id >> 22) / $3) <> ALL($4::BIGINT[])",
+                    thread_id, top_id, RECONCILE_RANGE_MS, seen
+                )
+                await conn.execute("""
+                    DELETE FROM range_checksums WHERE thread_id = $1 AND range_start <> ALL($2::BIGINT[])
+                """, thread_id, seen)
+                await publish_changes(conn, deletes=deleted_ids)
+    except DB_ERRORS as e:
+        logger.error(f"Error tombstoning unseen ranges: {e}")
+        return
+    message_catalog = message_catalogs.get(thread_id)
+    if message_catalog is not None:
+        for message_id in deleted_ids:
+            message_catalog.remove_message(message_id)
+    if deleted_ids:
+        logger.info(f"Reconciliation marked {len(deleted_ids)} messages in empty ranges as deleted.")
+
+
+@db_timed
+async def _get_sync_state(thread_id):
+    """
+    (high-water mark, 最終全件同期日時) を返す。
+    sync_state が未作成のスレッドは messages の最大 message_id を初期値にする。
+    """
+    pool = get_db_pool()
+    if not pool:
+        return None
+    try:
+        row = await pool.fetchrow("SELECT last_message_id, last_full_sync_at FROM sync_state WHERE thread_id = $1", thread_id)
+        if row:
+            return row["last_message_id"], row["last_full_sync_at"]
+        return await pool.fetchval("SELECT MAX(message_id) FROM messages WHERE thread_id = $1", thread_id), None
+    except DB_ERRORS as e:
+        logger.error(f"Error reading sync state: {e}")
+        return None
+
+
+@db_timed
+async def _set_sync_state(thread_id, last_message_id, full_sync=False):
+    pool = get_db_pool()
+    if not pool:
+        return
+    try:
+        await pool.execute("""
+            INSERT INTO sync_state (thread_id, last_message_id, last_full_sync_at)
+            VALUES ($1, $2, CASE WHEN $3::BOOLEAN THEN now() END)
+            ON CONFLICT (thread_id) DO UPDATE SET
+                last_message_id = GREATEST(sync_state.last_message_id, EXCLUDED.last_message_id),
+                last_full_sync_at = COALESCE(EXCLUDED.last_full_sync_at, sync_state.last_full_sync_at)
+        """, thread_id, last_message_id, full_sync)
+    except DB_ERRORS as e:
+        logger.error(f"Error updating sync state: {e}")
+
+
+@db_timed
+async def bulk_save_messages_to_db(messages):
+    if not messages:
+        return True
+    pool = get_db_pool()
+    if not pool:
+        return False
+    rows = [(m.id, m.channel.id, m.author.id, m.content) for m in messages]
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                inserted = await insert_messages(conn, rows)
+                await publish_changes(conn, messages=[(m.id, m.channel.id, m.author.id) for m in messages])
+    except DB_ERRORS as e:
         logger.error(f"Error during bulk insert: {e}")
-    finally:
-        release_db_connection(conn)
+        return False
+    logger.info(f"Bulk inserted {inserted} new of {len(messages)} messages without reactions.")
+    for message in messages:
+        message_catalog = message_catalogs.get(message.channel.id)
+        if message_catalog is not None:
+            message_catalog.add_message(message.id, message.author.id)
+    return True
 
 
 ########################
 # Bot起動
 ########################
-if DISCORD_TOKEN:
-    try:
-        bot.run(DISCORD_TOKEN)
-    except Exception as e:
-        logger.error(f"Error starting the bot: {e}")
-        if db_pool:
-            db_pool.closeall()
-            logger.info("Closed all database connections.")
-else:
-    logger.error("DISCORD_TOKEN が設定されていません。")
+if __name__ == "__main__":
+    if DISCORD_TOKEN:
+        try:
+            # discord.py 独自の同期ハンドラは付けず、ルートロガーのキュー経由で出力する
+            bot.run(DISCORD_TOKEN, log_handler=None)
+        except Exception as e:
+            logger.error(f"Error starting the bot: {e}")
+    else:
+        logger.error("DISCORD_TOKEN が設定されていません。")